@@ -1,288 +1,196 @@
-from request import shopware_request, inventree_request
-from db import get_db, close_db
+import json
+
+from request import inventree_request
+from db import unit_of_work, content_hash
 from log_config import setup_logging
+from workers import run_parallel, Batch
+from inventree_index import company_index
 
 logging = setup_logging()
 
 
+# The addresses are read from Shopware together with the customers, see customers.update_customers_shopware
 def update_addresses():
     logging.info("Starte Adressen Update")
 
-    update_addresses_shopware()  # Update the addresse from Shopware
     sync_inventree()  # Sync the addresses to Inventree
 
     logging.info("Adressen Update abgeschlossen")
 
 
-# Updates the addresses from Shopware
-def update_addresses_shopware():
-    limit = 500
-    page = 1
-    counter_addr = 0
-    counter_customer = 0
-
-    logging.info("Updating customer address db from Shopware")
-
-    conn, cursor = get_db()
-
-    # Reset all updated flags
-    cursor.execute("UPDATE addresses SET updated = 0")
-    conn.commit()
-
-    while True:
-        customers_data, data_count = shopware_request(
-            "get",
-            "/api/customer",
-            page=page,
-            limit=limit,
-            additions="associations[addresses][]",
-        )  # Request a page of customer informations containing addresses
-
-        if customers_data is None:
-            break
-
-        for customer in customers_data:  # For each customer in the page
-            addresses = customer["addresses"]  # Extract the addresses of the customer
-
-            cursor.execute(
-                """
-                           SELECT id FROM customers WHERE shopware_id = ?
-                           """,
-                (customer["id"],),
-            )  # Check if the customer is already in the database
+# Writes the addresses of a page of Shopware customers (fetched with the addresses
+# association) with one batched upsert. Unchanged rows are skipped by their content hash,
+# changed rows already in Inventree get needs_update. Returns the number of rows written.
+def upsert_addresses_db(customers_data, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        cursor.execute(
+            "SELECT shopware_id, id FROM customers WHERE shopware_id IN (SELECT value FROM json_each(?))",
+            (json.dumps([customer["id"] for customer in customers_data]),),
+        )
+        customer_ids = dict(cursor.fetchall())
 
-            customer_id = cursor.fetchone()[0]
+        rows = []
 
-            if customer_id is None:
-                logging.warning(
-                    f"Kunde {customer['id']} nicht in der Datenbank gefunden"
-                )
+        for customer in customers_data:
+            if customer["id"] not in customer_ids:
+                logging.warning(f"Kunde {customer['id']} nicht in der Datenbank gefunden")
                 continue
 
-            for address in addresses:  # For each address of the customer
-                cursor.execute(
-                    """
-                    SELECT id FROM addresses WHERE shopware_id = ?
-                    """,
-                    (address["id"],),
+            for address in customer["addresses"]:
+                values = (
+                    customer_ids[customer["id"]],
+                    address["firstName"],
+                    address["lastName"],
+                    address["zipcode"],
+                    address["city"],
+                    address["street"],
                 )
+                rows.append((address["id"],) + values + (content_hash(*values),))
 
-                address_exists = (
-                    cursor.fetchone()
-                )  # Check if the address is already in the database
-
-                data = {
-                    "shopware_id": address["id"],
-                    "is_in_shopware": 1,
-                    "customer_id": customer_id,
-                    "firstName": address["firstName"],
-                    "lastName": address["lastName"],
-                    "zipcode": address["zipcode"],
-                    "city": address["city"],
-                    "street": address["street"],
-                    "updated": True,
-                }
-
-                if (
-                    address_exists is None
-                ):  # When the address is not in the database, insert it
-                    create_address_db(data)
-
-                else:  # When the address is already in the database, update it
-                    data["id"] = address_exists[0]
-                    update_address_db(data)
-
-                counter_addr += 1
-
-            counter_customer += 1
-
-        conn.commit()
-
-        if data_count < limit:
-            break
-
-        page += 1
-
-    # Set all addresses that are not updated to not in shopware
-    cursor.execute("""
-        UPDATE addresses SET is_in_shopware = 0 
-        WHERE updated = 0 OR updated IS NULL
-    """)
-    conn.commit()
+        cursor.executemany(
+            """
+            INSERT INTO addresses (shopware_id, is_in_shopware, customer_id, firstName, lastName, zipcode, city, street, content_hash)
+            VALUES (?, 1, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (shopware_id) DO UPDATE SET
+                is_in_shopware = 1,
+                customer_id = excluded.customer_id,
+                firstName = excluded.firstName,
+                lastName = excluded.lastName,
+                zipcode = excluded.zipcode,
+                city = excluded.city,
+                street = excluded.street,
+                needs_update = CASE
+                    WHEN addresses.inventree_id IS NOT NULL AND addresses.content_hash IS NOT NULL THEN 1
+                    ELSE addresses.needs_update
+                END,
+                content_hash = excluded.content_hash
+            WHERE addresses.content_hash IS NOT excluded.content_hash
+            OR addresses.is_in_shopware IS NOT 1
+            """,
+            rows,
+        )
 
-    close_db(conn)
-    logging.info(
-        f"{counter_addr} Adressen von {counter_customer} Kunden erfolgreich aktualisiert"
-    )
+        return cursor.rowcount
 
 
-# Syncs the addresses to Inventree
+# Syncs the addresses to Inventree. Addresses of customers that are not in Inventree yet
+# are deferred to the next pass, the others are created in parallel.
 def sync_inventree():
-    conn, cursor = get_db()
-
-    cursor.execute(
-        "SELECT id FROM addresses WHERE (is_in_inventree = 0 OR inventree_id IS NULL) AND is_in_shopware = 1"
-    )
-
-    ids = cursor.fetchall()
-
-    counter = 0
-
-    for id in ids:
-        address_id = create_address_inventree(id[0])
-
-        if address_id is not None:
-            counter += 1
-
-    logging.info(f"{counter} Adressen wurden hinzugefügt")
-    close_db(conn)
+    with unit_of_work() as (conn, cursor):
+        cursor.execute(
+            """SELECT addresses.id, customers.inventree_id, addresses.firstName, addresses.lastName,
+                      addresses.zipcode, addresses.city, addresses.street, addresses.customer_id, customers.id
+               FROM addresses
+               LEFT JOIN customers ON addresses.customer_id = customers.id
+               WHERE (addresses.is_in_inventree = 0 OR addresses.inventree_id IS NULL) AND addresses.is_in_shopware = 1"""
+        )
 
+        ready = []
+        deferred = 0
+        orphaned = set()
 
-# Creates an address in the database with the given values
-def create_address_db(data):
-    conn, cursor = get_db()
-
-    # Lists to store fields and values
-    fields = []
-    values = []
-
-    # List of all possible fields
-    possible_fields = [
-        "inventree_id",
-        "shopware_id",
-        "is_in_inventree",
-        "is_in_shopware",
-        "customer_id",
-        "firstName",
-        "lastName",
-        "zipcode",
-        "city",
-        "street",
-        "updated",
-    ]
-
-    # Add only fields that exist in data
-    for field in possible_fields:
-        if field in data:
-            fields.append(field)
-            # Convert boolean fields
-            if field in ["is_in_inventree", "is_in_shopware"]:
-                values.append(bool(data[field]))
+        for address in cursor.fetchall():
+            if address[8] is None:  # Customer does not exist anymore
+                orphaned.add(address[7])
+            elif address[1] is None:  # Customer is not in Inventree yet
+                deferred += 1
             else:
-                values.append(data[field])
-
-    if not fields:
-        logging.warning("No fields provided for create_address_db")
-        return None
+                ready.append(address[:7])
 
-    # Construct and execute query
-    placeholders = ",".join(["?" for _ in fields])
-    query = f"""
-        INSERT INTO addresses ({",".join(fields)})
-        VALUES ({placeholders})
-        RETURNING id
-    """
-
-    cursor.execute(query, values)
-    id = cursor.fetchone()[0]
-    conn.commit()
-    close_db(conn)
-
-    return id
-
-
-# Updates an address in the database with the given values
-def update_address_db(data):
-    if "id" not in data:
-        logging.error("No id provided for update_address_db")
-        return
-
-    conn, cursor = get_db()
-
-    # Build dynamic UPDATE query
-    fields = []
-    values = []
-
-    # List of all possible fields
-    possible_fields = [
-        "inventree_id",
-        "shopware_id",
-        "is_in_inventree",
-        "is_in_shopware",
-        "customer_id",
-        "firstName",
-        "lastName",
-        "zipcode",
-        "city",
-        "street",
-        "updated",
-    ]
-
-    # Add only fields that exist in data
-    for field in possible_fields:
-        if field in data:
-            fields.append(f"{field} = ?")
-            # Convert boolean fields
-            if field in ["is_in_inventree", "is_in_shopware"]:
-                values.append(bool(data[field]))
-            else:
-                values.append(data[field])
+        if orphaned:
+            logging.error(f"{len(orphaned)} Kunden nicht in der Datenbank gefunden, Adressen werden gelöscht")
+            cursor.executemany(
+                """DELETE FROM addresses WHERE customer_id = ? AND id NOT IN (SELECT address_id FROM orders WHERE address_id IS NOT NULL)""",
+                [(customer_id,) for customer_id in orphaned],
+            )
+            conn.commit()
 
-    if not fields:
-        logging.warning("No fields to update")
-        return
+        if deferred:
+            logging.warning(f"{deferred} Adressen zurückgestellt, Kunde existiert noch nicht in Inventree")
 
-    # Add id to values
-    values.append(data["id"])
+        if ready:
+            company_index.load_addresses()  # Existing addresses are linked, not created again
 
-    # Construct and execute query
-    query = f"UPDATE addresses SET {', '.join(fields)} WHERE id = ?"
-    cursor.execute(query, values)
+        def flush(rows):
+            cursor.executemany(
+                """UPDATE addresses SET is_in_inventree = 1, inventree_id = ? WHERE id = ?""",
+                rows,
+            )
+            conn.commit()
 
-    conn.commit()
-    close_db(conn)
+        batch = Batch(flush)
+        counter = 0
 
+        for address, address_id in run_parallel(post_address_inventree, ready):
+            if address_id is not None:
+                batch.add((address_id, address[0]))
+                counter += 1
 
-# Creates the address in Inventree with the given id
-def create_address_inventree(id):
-    conn, cursor = get_db()
-
-    cursor.execute(
-        """ SELECT id, customer_id, firstName, lastName, zipcode, city, street FROM addresses WHERE id = ?""",
-        (id,),
-    )  #
-    address = cursor.fetchone()
-
-    cursor.execute(
-        """ SELECT inventree_id FROM customers WHERE id = ?""", (address[1],)
-    )
-    customer_id = cursor.fetchone()
-    
-    if customer_id is None:     # When the customer is not in Inventree, or does not exist
-        cursor.execute("""SELECT id FROM customers WHERE id = ?""", (address[1],))
-
-        customer = cursor.fetchone()
-
-        if customer is None:
-            logging.error(f"Kunde {address[1]} nicht in der Datenbank gefunden")
-            
-            cursor.execute("""DELETE FROM addresses WHERE customer_id = ?""", (address[1],))
-            conn.commit()
+        batch.flush_all()
+        company_index.clear_addresses()  # Later lookups ask Inventree, the list goes stale
 
-        else:
-            logging.warning(
-                f"Kunde {customer[0]} Existiert nicht in Inventree, aber in der Datenbank"
-            )
+        logging.info(f"{counter} Adressen wurden hinzugefügt")
 
-        return None
 
+# Creates an address in the database with the given values
+def create_address_db(data, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        # Lists to store fields and values
+        fields = []
+        values = []
+
+        # List of all possible fields
+        possible_fields = [
+            "inventree_id",
+            "shopware_id",
+            "is_in_inventree",
+            "is_in_shopware",
+            "customer_id",
+            "firstName",
+            "lastName",
+            "zipcode",
+            "city",
+            "street",
+            "updated",
+        ]
+
+        # Add only fields that exist in data
+        for field in possible_fields:
+            if field in data:
+                fields.append(field)
+                # Convert boolean fields
+                if field in ["is_in_inventree", "is_in_shopware"]:
+                    values.append(bool(data[field]))
+                else:
+                    values.append(data[field])
+
+        if not fields:
+            logging.warning("No fields provided for create_address_db")
+            return None
+
+        # Construct and execute query
+        placeholders = ",".join(["?" for _ in fields])
+        query = f"""
+            INSERT INTO addresses ({",".join(fields)})
+            VALUES ({placeholders})
+            RETURNING id
+        """
+
+        cursor.execute(query, values)
+        id = cursor.fetchone()[0]
+
+        return id
+
+
+# Address fields for an address row (id, company, firstName, lastName, zipcode, city, street)
+def address_payload(address):
     if address[4] is None:
         postal_code = ""
     else:
         postal_code = address[4][:10]
-    
-    data = {
-        "company": customer_id[0],
+
+    return {
+        "company": address[1],
         "title": address[0],
         "line1": (address[2] + " " + address[3])[:50],
         "line2": address[6][:50],
@@ -290,25 +198,73 @@ def create_address_inventree(id):
         "postal_city": address[5],
     }
 
+
+# Creates an address row (id, company, firstName, lastName, zipcode, city, street) in Inventree,
+# an existing address of the company with the same lines is linked instead
+def post_address_inventree(address):
+    data = address_payload(address)
+
+    existing = company_index.address(data)
+    if existing is not None:
+        return existing
+
     response = inventree_request("post", "/api/company/address/", data=data)
 
     try:
-        address_id = response["pk"]
+        company_index.add_address(data, response["pk"])
+        return response["pk"]
     except TypeError:
         return None
-    
-    try:
+
+
+# Creates the address in Inventree with the given id
+def create_address_inventree(id, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
         cursor.execute(
-            """
-            UPDATE addresses SET is_in_inventree = 1, inventree_id = ? WHERE id = ?
-            """,
-            (address_id, id),
+            """ SELECT id, customer_id, firstName, lastName, zipcode, city, street FROM addresses WHERE id = ?""",
+            (id,),
+        )  #
+        address = cursor.fetchone()
+
+        cursor.execute(
+            """ SELECT inventree_id FROM customers WHERE id = ?""", (address[1],)
         )
-    except Exception as e:
-        logging.error(f"konnte nicht in Inventree erstellt werden: {e}")
-        return None
+        customer_id = cursor.fetchone()
+
+        if customer_id is None or customer_id[0] is None:     # When the customer is not in Inventree, or does not exist
+            cursor.execute("""SELECT id FROM customers WHERE id = ?""", (address[1],))
+
+            customer = cursor.fetchone()
 
-    conn.commit()
-    close_db(conn)
+            if customer is None:
+                logging.error(f"Kunde {address[1]} nicht in der Datenbank gefunden")
+
+                cursor.execute(
+                    """DELETE FROM addresses WHERE customer_id = ? AND id NOT IN (SELECT address_id FROM orders WHERE address_id IS NOT NULL)""",
+                    (address[1],),
+                )
+
+            else:
+                logging.warning(
+                    f"Kunde {customer[0]} Existiert nicht in Inventree, aber in der Datenbank"
+                )
+
+            return None
+
+        address_id = post_address_inventree((address[0], customer_id[0]) + address[2:])
+
+        if address_id is None:
+            return None
+
+        try:
+            cursor.execute(
+                """
+                UPDATE addresses SET is_in_inventree = 1, inventree_id = ? WHERE id = ?
+                """,
+                (address_id, id),
+            )
+        except Exception as e:
+            logging.error(f"konnte nicht in Inventree erstellt werden: {e}")
+            return None
 
-    return address_id
+        return address_id
@@ -3,13 +3,80 @@ import requests
 import datetime
 import json
 import time
+import threading
 
 from log_config import setup_logging
 
 logging = setup_logging()
 
+AUTH_FILE = os.getenv("AUTH_FILE", "auth.json")
+AUTH_PERSIST = os.getenv("AUTH_PERSIST", "true").lower() in ("1", "true", "yes")
 
-# Authenticates against Shopware and saves the token in a file
+BACKENDS = ("shopware", "inventree")
+REFRESH_MARGIN = {"shopware": 25, "inventree": 60 * 60}  # Seconds before expiry
+RETRY_DELAY = 30  # Seconds to wait before retrying a failed refresh
+MAX_SLEEP = 60 * 60
+
+_refresh_locks = {backend: threading.Lock() for backend in BACKENDS}
+_wakeup = threading.Event()
+_ANY_TOKEN = object()  # Forces refresh_token to request a new token
+
+
+# Thread-safe in-memory token store, the auth file is only used to keep tokens across restarts
+class TokenStore:
+    def __init__(self, path=AUTH_FILE, persist=AUTH_PERSIST):
+        self.path = path
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._data = {}
+
+        if self.persist:
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r") as f:
+                self._data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to load auth file, starting without tokens: {e}")
+
+    # Writes to a temporary file first, so the auth file is never left half written
+    def _save(self, data):
+        tmp_path = f"{self.path}.tmp"
+
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Failed to persist auth data: {e}")
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._data)
+
+    # Replaces the given fields in one step, readers never see a partial update
+    def update(self, values):
+        with self._lock:
+            data = dict(self._data)
+            data.update(values)
+            self._data = data
+
+            if self.persist:
+                self._save(data)
+
+
+tokens = TokenStore()
+
+
+# Authenticates against Shopware and stores the token
 def shopware_auth():
     base_url = os.getenv("SHOPWARE_URL")
     access_key = os.getenv("SHOPWARE_ACCESS_KEY")
@@ -44,21 +111,8 @@ def shopware_auth():
             ).timestamp(),
         }
 
-        if not os.path.exists("auth.json"):
-            with open("auth.json", "w") as f:
-                json.dump(auth_file, f)
-        else:
-            # Read existing file
-            with open("auth.json", "r") as f:
-                existing_data = json.load(f)
-
-            # Update only the fields from auth_file
-            for key in auth_file:
-                existing_data[key] = auth_file[key]
-
-            # Write back the updated data
-            with open("auth.json", "w") as f:
-                json.dump(existing_data, f)
+        tokens.update(auth_file)
+        return True
 
     except requests.exceptions.Timeout:
         logging.error("Request timed out after 10 seconds")
@@ -72,7 +126,7 @@ def shopware_auth():
         return None
 
 
-# Authenticates against Inventree and saves the token in a file
+# Authenticates against Inventree and stores the token
 def inventree_auth():
     base_url = os.getenv("INVENTREE_URL")
     username = os.getenv("INVENTREE_USER")
@@ -95,23 +149,11 @@ def inventree_auth():
         auth_file = {
             "inventree_token": response["token"],
             "inventree_expires": response["expiry"],
+            "inventree_expires_at": parse_inventree_expiry(response["expiry"]),
         }
 
-        if not os.path.exists("auth.json"):
-            with open("auth.json", "w") as f:
-                json.dump(auth_file, f)
-        else:
-            # Read existing file
-            with open("auth.json", "r") as f:
-                existing_data = json.load(f)
-
-            # Update only the fields from auth_file
-            for key in auth_file:
-                existing_data[key] = auth_file[key]
-
-            # Write back the updated data
-            with open("auth.json", "w") as f:
-                json.dump(existing_data, f)
+        tokens.update(auth_file)
+        return True
 
     except requests.exceptions.Timeout:
         logging.error("Request timed out after 10 seconds")
@@ -125,65 +167,101 @@ def inventree_auth():
         return None
 
 
+# Converts the expiry date returned by Inventree into a timestamp
+def parse_inventree_expiry(expiry):
+    return datetime.datetime.strptime(expiry, "%Y-%m-%d").timestamp()
+
+
+# Returns the timestamp at which the token of a backend has to be refreshed
+def refresh_due(backend, data=None):
+    if data is None:
+        data = tokens.snapshot()
+
+    if f"{backend}_token" not in data:
+        return None
+
+    try:
+        if backend == "shopware":
+            expires = data["shopware_expires"]
+        elif "inventree_expires_at" in data:
+            expires = data["inventree_expires_at"]
+        else:  # Auth files written before the timestamp was stored
+            expires = parse_inventree_expiry(data["inventree_expires"])
+    except (KeyError, ValueError):
+        return None
+
+    return expires - REFRESH_MARGIN[backend]
+
+
+# Checks if the token of a backend is still valid
+def check_token(backend):
+    due = refresh_due(backend)
+    return due is not None and due > time.time()
+
+
 # Checks if the shopware token is still valid
 def check_shopware_token():
-    if not os.path.exists("auth.json"):
-        return False
-
-    with open("auth.json", "r") as f:
-        data = json.load(f)
-
-    if "shopware_token" in data and "shopware_expires" in data:
-        # Add 15 seconds buffer before expiration
-        if (
-            data["shopware_expires"]
-            > (datetime.datetime.now() + datetime.timedelta(seconds=25)).timestamp()
-        ):
-            return True
-
-    return False
+    return check_token("shopware")
 
 
 # Checks if the inventree token is still valid
 def check_inventree_token():
-    if not os.path.exists("auth.json"):
-        return False
+    return check_token("inventree")
 
-    with open("auth.json", "r") as f:
-        data = json.load(f)
 
-    if "inventree_token" in data and "inventree_expires" in data:
-        expiry_date = datetime.datetime.strptime(data["inventree_expires"], "%Y-%m-%d")
-        if expiry_date.timestamp() > datetime.datetime.now().timestamp():
+# Refreshes the token of a backend. Concurrent callers share one refresh: when
+# stale_token is given and the stored token already differs, nothing is requested.
+def refresh_token(backend, stale_token=_ANY_TOKEN):
+    with _refresh_locks[backend]:
+        if stale_token is not _ANY_TOKEN and tokens.get(f"{backend}_token") != stale_token:
             return True
 
-    return False
+        logging.info(f"{backend.capitalize()} token invalid, refreshing")
+
+        if _authenticators[backend]():
+            logging.info(f"{backend.capitalize()} token refreshed")
+            refreshed = True
+        else:
+            logging.error(f"{backend.capitalize()} token could not be refreshed")
+            refreshed = False
+
+    _wakeup.set()  # Let the auth job reschedule with the new expiry
+    return refreshed
 
 
 def check_tokens():
-    if not check_shopware_token():
-        logging.info("Shopware token invalid, refreshing")
-        shopware_auth()
-        logging.info("Shopware token refreshed")
+    for backend in BACKENDS:
+        if not check_token(backend):
+            refresh_token(backend)
+
 
-    if not check_inventree_token():
-        logging.info("Inventree token invalid, refreshing")
-        inventree_auth()
-        logging.info("Inventree token refreshed")
+# Seconds until the next token needs to be refreshed
+def seconds_until_refresh():
+    data = tokens.snapshot()
+    delay = MAX_SLEEP
 
+    for backend in BACKENDS:
+        due = refresh_due(backend, data)
 
-# Checks all tokens every second if they are still valid
+        if due is None or due <= time.time():  # The last refresh failed
+            delay = min(delay, RETRY_DELAY)
+        else:
+            delay = min(delay, due - time.time())
+
+    return max(delay, 1)
+
+
+# Refreshes the tokens shortly before they expire, sleeps in between.
+# refresh_token wakes the job up so it picks up tokens refreshed on demand.
 def auth_job():
     logging.debug("Starting authentication job")
     while True:
-        if not check_shopware_token():
-            logging.info("Shopware token invalid, refreshing")
-            shopware_auth()
-            logging.info("Shopware token refreshed")
+        check_tokens()
+
+        _wakeup.clear()
+        delay = seconds_until_refresh()
+        logging.debug(f"Next token refresh check in {int(delay)} seconds")
+        _wakeup.wait(delay)
 
-        if not check_inventree_token():
-            logging.info("Inventree token invalid, refreshing")
-            inventree_auth()
-            logging.info("Inventree token refreshed")
 
-        time.sleep(1)
+_authenticators = {"shopware": shopware_auth, "inventree": inventree_auth}
@@ -1,9 +1,46 @@
-from db import get_db, close_db
-from request import inventree_request, shopware_request
+import json
+
+from db import (
+    unit_of_work,
+    get_sync_state,
+    set_sync_state,
+    content_hash,
+    diff_shopware_ids,
+)
+from request import (
+    inventree_request,
+    shopware_search,
+    shopware_search_stream,
+    shopware_ids,
+    build_criteria,
+    changed_since_filter,
+    latest_change,
+    SHOPWARE_INCREMENTAL,
+    SHOPWARE_STREAM,
+    SHOPWARE_PAGE_SIZE,
+)
+from addresses import upsert_addresses_db
+from inventree_index import company_index
 from log_config import setup_logging
+from workers import run_parallel, Batch, Paginator, StreamPaginator
 
 logging = setup_logging()
 
+# Fields read from Shopware for the customer and address tables
+CUSTOMER_INCLUDES = {
+    "customer": ["id", "firstName", "lastName", "email", "createdAt", "updatedAt", "addresses"],
+    "customer_address": [
+        "id",
+        "firstName",
+        "lastName",
+        "zipcode",
+        "city",
+        "street",
+        "createdAt",
+        "updatedAt",
+    ],
+}
+
 
 def update_customers():
     logging.info("Updating customers")
@@ -14,257 +51,296 @@ def update_customers():
     logging.info("Customers updated")
 
 
-# Check if customers in db are still in Shopware, and update them if needed
+# Check if customers and their addresses in db are still in Shopware, and update them if needed.
+# Both tables are filled from one scan of the customers with their addresses. After the first
+# complete pass only customers changed since the last pass are fetched.
 def update_customers_shopware():
-    limit = 500
-    page = 1
+    limit = SHOPWARE_PAGE_SIZE
     counter = 0
     counter_new = 0
     counter_updated = 0
+    counter_addr = 0
 
-    logging.info("Updating customer db from Shopware")
+    logging.info("Updating customer and address db from Shopware")
 
-    conn, cursor = get_db()
+    change_fields = ("updatedAt", "createdAt", "addresses.updatedAt", "addresses.createdAt")
 
-    # Reset all updated flags
-    cursor.execute("UPDATE addresses SET updated = 0")
-    conn.commit()
+    with unit_of_work() as (conn, cursor):
+        since = get_sync_state("customers_changed_since", conn) if SHOPWARE_INCREMENTAL else None
 
-    while True:
-        customers_data, data_count = shopware_request(
-            "get", "/api/customer", page=page, limit=limit
-        )  # Request a page of customers
+        if since is not None:
+            logging.info(f"Fetching customers changed since {since}")
 
-        if customers_data is None:
-            break
+        latest = since
 
-        for customer in customers_data:  # For each customer in the page
-            cursor.execute(
-                """
-                           SELECT id FROM customers WHERE shopware_id = ?
-                           """,
-                (customer["id"],),
-            )  # Check if the customer is in the database
+        criteria = build_criteria(
+            limit=limit,
+            filters=changed_since_filter(since, change_fields) if since is not None else None,
+            sort=["createdAt", "id"],  # Unique order, offset pages must not shift between requests
+            associations=["addresses"],
+            includes=CUSTOMER_INCLUDES,
+            total_count=True,
+        )
 
-            result = cursor.fetchone()
+        if SHOPWARE_STREAM:  # Large pages, decoded record by record
+            pages = StreamPaginator(
+                lambda page: shopware_search_stream("customer", dict(criteria, page=page)),
+                limit,
+            )
+        else:  # Pages of customers containing their addresses, fetched ahead
+            pages = Paginator(
+                lambda page: shopware_search("customer", dict(criteria, page=page)), limit
+            )
 
-            data = {
-                "shopware_id": customer["id"],
-                "is_in_shopware": True,
-                "firstName": customer["firstName"],
-                "lastName": customer["lastName"],
-                "email": customer["email"],
-                "updated": True,
-            }
+        for customers_data in pages:
+            new, updated = upsert_customers_db(customers_data, conn)
+            counter_addr += upsert_addresses_db(customers_data, conn)
 
-            if result is None:
-                id = create_customer_db(data)
+            counter += len(customers_data)
+            counter_new += new
+            counter_updated += updated
 
-                if id is None:
-                    logging.error(f"Failed to create customer {customer['id']} in db")
-                    continue
+            latest = latest_change(customers_data, latest)
+            for customer in customers_data:
+                latest = latest_change(customer["addresses"], latest)
 
-                counter_new += 1
+            conn.commit()
 
-            else:
-                data["id"] = result[0]
-                update_customer_db(data)
-                counter_updated += 1
+        complete = pages.complete
 
-            counter += 1
+        # Deletions are found by diffing the id sets, this also works for incremental passes
+        for table, entity in (("customers", "customer"), ("addresses", "customer-address")):
+            ids = shopware_ids(entity)
 
-        conn.commit()
+            if ids is not None:
+                missing = diff_shopware_ids(table, ids, conn)
+                if missing:
+                    logging.info(f"{missing} {table} nicht mehr in Shopware")
 
-        if data_count < limit:
-            break
+        if complete and latest is not None:
+            set_sync_state("customers_changed_since", latest, conn)
 
-        page += 1
+        conn.commit()
 
-    # Set all customers that are not updated to not in shopware
-    cursor.execute("""
-        UPDATE customers SET is_in_shopware = 0 
-        WHERE updated = 0 OR updated IS NULL
-    """)
-    conn.commit()
+        logging.info(
+            f"{counter} Kunden verarbeiten, {counter_new} neu, {counter_updated} geändert, {counter_addr} Adressen geändert"
+        )
+
+
+# Writes a page of Shopware customers with one batched upsert. Rows whose content hash did not
+# change are skipped, changed rows already in Inventree get needs_update. Returns (new, changed).
+def upsert_customers_db(customers_data, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        cursor.execute(
+            "SELECT shopware_id FROM customers WHERE shopware_id IN (SELECT value FROM json_each(?))",
+            (json.dumps([customer["id"] for customer in customers_data]),),
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+
+        new_customers = [c for c in customers_data if c["id"] not in existing]
+
+        # New customers get a numbered lastName when the same person already exists,
+        # the known combinations are loaded once instead of probed per row
+        cursor.execute(
+            "SELECT firstName, lastName, email FROM customers WHERE email IN (SELECT value FROM json_each(?))",
+            (json.dumps([customer["email"] for customer in new_customers]),),
+        )
+        taken = set(cursor.fetchall())
+
+        rows = []
+
+        for customer in customers_data:
+            lastName = customer["lastName"]
+
+            if customer["id"] not in existing:
+                counter = 1
+
+                while (customer["firstName"], lastName, customer["email"]) in taken:
+                    lastName = f"{customer['lastName']} ({counter})"
+                    counter += 1
+
+                taken.add((customer["firstName"], lastName, customer["email"]))
+
+            rows.append(
+                (
+                    customer["id"],
+                    customer["firstName"],
+                    lastName,
+                    customer["email"],
+                    content_hash(customer["firstName"], customer["lastName"], customer["email"]),
+                )
+            )
+
+        cursor.executemany(
+            """
+            INSERT INTO customers (shopware_id, is_in_shopware, firstName, lastName, email, content_hash)
+            VALUES (?, 1, ?, ?, ?, ?)
+            ON CONFLICT (shopware_id) DO UPDATE SET
+                is_in_shopware = 1,
+                firstName = excluded.firstName,
+                lastName = excluded.lastName,
+                email = excluded.email,
+                needs_update = CASE
+                    WHEN customers.inventree_id IS NOT NULL AND customers.content_hash IS NOT NULL THEN 1
+                    ELSE customers.needs_update
+                END,
+                content_hash = excluded.content_hash
+            WHERE customers.content_hash IS NOT excluded.content_hash
+            OR customers.is_in_shopware IS NOT 1
+            """,
+            rows,
+        )
+
+        return len(new_customers), cursor.rowcount - len(new_customers)
+
+
+# Sync customers from db to Inventree, the companies are created in parallel
+def sync_inventree():
+    counter = 0
 
-    logging.info(
-        f"{counter} Kunden verarbeiten, {counter_new} neu, {counter_updated} aktualisiert"
-    )
-    close_db(conn)
+    with unit_of_work() as (conn, cursor):
+        cursor.execute(
+            "SELECT id, firstName, lastName, email FROM customers WHERE (is_in_inventree = 0 OR is_in_inventree IS NULL) AND is_in_shopware = 1"
+        )
 
+        customers = cursor.fetchall()
 
-# Sync customers from db to Inventree
-def sync_inventree():
-    counter = 0
+        if customers:
+            company_index.load_companies()  # Existing companies are linked, not created again
 
-    conn, cursor = get_db()
+        def flush(rows):
+            cursor.executemany(
+                "UPDATE customers SET inventree_id = ?, is_in_inventree = 1 WHERE id = ?",
+                rows,
+            )
+            conn.commit()
 
-    cursor.execute(
-        "SELECT id FROM customers WHERE (is_in_inventree = 0 OR is_in_inventree IS NULL) AND is_in_shopware = 1"
-    )
+        batch = Batch(flush)
 
-    ids = cursor.fetchall()
+        for customer, customer_id in run_parallel(post_customer_inventree, customers):
+            if customer_id is not None:
+                batch.add((customer_id, customer[0]))
+                counter += 1
 
-    for id in ids:
-        response = create_customer_inventree(id[0])
-        
-        if response is not None:
-            counter += 1
+        batch.flush_all()
+        company_index.clear_companies()  # Later lookups ask Inventree, the list goes stale
 
-    logging.info(f"{counter} Kunden erfolgreich in Inventree erstellt")
-    close_db(conn)
+        logging.info(f"{counter} Kunden erfolgreich in Inventree erstellt oder verknüpft")
 
 
 # Create a new customer in the database
-def create_customer_db(data):
-    conn, cursor = get_db()
-
-    original_lastName = data["lastName"]
-    counter = 1
-
-    # Check for existing combinations
-    while True:
-        cursor.execute("""
-            SELECT id FROM customers 
-            WHERE firstName = ? AND lastName = ? AND email = ?
-        """, (data["firstName"], data["lastName"], data["email"]))
+def create_customer_db(data, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        original_lastName = data["lastName"]
+        counter = 1
+
+        # Check for existing combinations
+        while True:
+            cursor.execute("""
+                SELECT id FROM customers 
+                WHERE firstName = ? AND lastName = ? AND email = ?
+            """, (data["firstName"], data["lastName"], data["email"]))
         
-        if not cursor.fetchone():
-            break
+            if not cursor.fetchone():
+                break
             
-        data["lastName"] = f"{original_lastName} ({counter})"
-        counter += 1
-
-    # Lists to store fields and values
-    fields = []
-    values = []
-
-    # List of all possible fields
-    possible_fields = [
-        "inventree_id",
-        "shopware_id",
-        "is_in_inventree",
-        "is_in_shopware",
-        "firstName", 
-        "lastName",
-        "email",
-        "updated",
-    ]
-
-    # Add only fields that exist in data
-    for field in possible_fields:
-        if field in data:
-            fields.append(field)
-            # Convert boolean fields
-            if field in ["is_in_inventree", "is_in_shopware"]:
-                values.append(bool(data[field]))
-            else:
-                values.append(data[field])
-
-    if not fields:
-        logging.warning("No fields provided for create_customer_db")
-        return None
-
-    # Construct and execute query
-    placeholders = ",".join(["?" for _ in fields])
-    query = f"""
-        INSERT INTO customers ({",".join(fields)})
-        VALUES ({placeholders})
-        RETURNING id
-    """
-
-    cursor.execute(query, values)
-    id = cursor.fetchone()[0]
-    conn.commit()
-    close_db(conn)
-
-    return id
-
-
-# Update a customer in the database
-def update_customer_db(data):
-    if "id" not in data:
-        logging.error("No id provided for update_customer_db")
-        return
-
-    conn, cursor = get_db()
-
-    # Build dynamic UPDATE query
-    fields = []
-    values = []
-
-    # List of all possible fields
-    possible_fields = [
-        "inventree_id",
-        "shopware_id",
-        "is_in_inventree",
-        "is_in_shopware",
-        "firstName",
-        "lastName",
-        "email",
-        "updated",
-    ]
-
-    # Add only fields that exist in data
-    for field in possible_fields:
-        if field in data:
-            fields.append(f"{field} = ?")
-            # Convert boolean fields
-            if field in ["is_in_inventree", "is_in_shopware"]:
-                values.append(bool(data[field]))
-            else:
-                values.append(data[field])
-
-    if not fields:
-        logging.warning("No fields to update")
-        return
-
-    # Add id to values
-    values.append(data["id"])
-
-    # Construct and execute query
-    query = f"UPDATE customers SET {', '.join(fields)} WHERE id = ?"
-    cursor.execute(query, values)
-
-    conn.commit()
-    close_db(conn)
-
-
-# creates a customer in Inventree with the given id
-def create_customer_inventree(id):
-    conn, cursor = get_db()
-
-    cursor.execute(
-        """SELECT firstName, lastName, email FROM customers WHERE id = ?""", (id,)
-    )
-    customer = cursor.fetchone()
+            data["lastName"] = f"{original_lastName} ({counter})"
+            counter += 1
 
-    data = {
+        # Lists to store fields and values
+        fields = []
+        values = []
+
+        # List of all possible fields
+        possible_fields = [
+            "inventree_id",
+            "shopware_id",
+            "is_in_inventree",
+            "is_in_shopware",
+            "firstName", 
+            "lastName",
+            "email",
+            "updated",
+        ]
+
+        # Add only fields that exist in data
+        for field in possible_fields:
+            if field in data:
+                fields.append(field)
+                # Convert boolean fields
+                if field in ["is_in_inventree", "is_in_shopware"]:
+                    values.append(bool(data[field]))
+                else:
+                    values.append(data[field])
+
+        if not fields:
+            logging.warning("No fields provided for create_customer_db")
+            return None
+
+        # Construct and execute query
+        placeholders = ",".join(["?" for _ in fields])
+        query = f"""
+            INSERT INTO customers ({",".join(fields)})
+            VALUES ({placeholders})
+            RETURNING id
+        """
+
+        cursor.execute(query, values)
+        id = cursor.fetchone()[0]
+
+        return id
+
+
+# Company fields for a customer row (id, firstName, lastName, email)
+def customer_payload(customer):
+    return {
         "is_customer": True,
-        "name": customer[0] + " " + customer[1],
+        "name": customer[1] + " " + customer[2],
         "description": "",
         "website": "",
         "currency": "EUR",
         "phone": "",
-        "email": customer[2],
+        "email": customer[3],
         "is_supplier": False,
         "is_manufacturer": False,
         "active": True,
     }
 
+
+# Creates the company in Inventree for a customer row (id, firstName, lastName, email),
+# an existing company with the same name and email is linked instead
+def post_customer_inventree(customer):
+    data = customer_payload(customer)
+
+    existing = company_index.company(data)
+    if existing is not None:
+        return existing
+
     response = inventree_request("post", "/api/company/", data=data)
-    
+
     try:
-        customer_id = response["pk"]
+        company_index.add_company(data, response["pk"])
+        return response["pk"]
     except TypeError:
         return None
 
-    cursor.execute(
-        "UPDATE customers SET inventree_id = ?, is_in_inventree = 1 WHERE id = ?",
-        (customer_id, id),
-    )
 
-    conn.commit()
-    close_db(conn)
+# creates a customer in Inventree with the given id
+def create_customer_inventree(id, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        cursor.execute(
+            """SELECT id, firstName, lastName, email FROM customers WHERE id = ?""", (id,)
+        )
+        customer = cursor.fetchone()
+
+        customer_id = post_customer_inventree(customer)
+
+        if customer_id is None:
+            return None
+
+        cursor.execute(
+            "UPDATE customers SET inventree_id = ?, is_in_inventree = 1 WHERE id = ?",
+            (customer_id, id),
+        )
 
-    return customer_id
+        return customer_id
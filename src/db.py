@@ -1,14 +1,51 @@
+import hashlib
+import json
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 
 from log_config import setup_logging
 
 logging = setup_logging()
 
+_local = threading.local()
+
+DB_PATH = "db/database.db"
+DB_PROFILE = os.getenv("DB_PROFILE", "fast").lower()  # "safe" or "fast"
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", 64 * 1024))  # Page cache per connection in KiB
+DB_MMAP_SIZE = os.getenv("DB_MMAP_SIZE")  # Bytes of the database file mapped into memory
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", 30000))  # Milliseconds to wait for a lock
+
+# Both profiles use WAL, so readers never block the writer. "safe" still syncs on every
+# commit, "fast" only syncs at checkpoints: a power loss can drop the last commits,
+# but never corrupts the database.
+DB_PROFILES = {
+    "safe": {"synchronous": "FULL", "mmap_size": 0},
+    "fast": {"synchronous": "NORMAL", "mmap_size": 256 * 1024 * 1024},
+}
+
+if DB_PROFILE not in DB_PROFILES:
+    logging.warning(f"Unknown DB_PROFILE {DB_PROFILE}, using fast")
+    DB_PROFILE = "fast"
+
 
 # Function to get the database connection/cursor
 def get_db():
-    conn = sqlite3.connect("db/database.db")
-    return conn, conn.cursor()
+    profile = DB_PROFILES[DB_PROFILE]
+    mmap_size = int(DB_MMAP_SIZE) if DB_MMAP_SIZE is not None else profile["mmap_size"]
+
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT / 1000)
+    cursor = conn.cursor()
+
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute(f"PRAGMA synchronous = {profile['synchronous']}")
+    cursor.execute(f"PRAGMA cache_size = {-DB_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size = {mmap_size}")
+    cursor.execute("PRAGMA foreign_keys = ON")
+    cursor.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}")
+
+    return conn, cursor
 
 
 # Function to close the database connection
@@ -16,6 +53,84 @@ def close_db(conn):
     conn.close()
 
 
+# Unit of work: yields (conn, cursor) and commits once when the outermost block ends,
+# or rolls back on error. Helpers given conn, and nested blocks in the same thread,
+# reuse the open connection instead of connecting and committing on their own.
+@contextmanager
+def unit_of_work(conn=None):
+    if conn is None:
+        conn = getattr(_local, "conn", None)
+
+    if conn is not None:
+        yield conn, conn.cursor()
+        return
+
+    conn, cursor = get_db()
+    _local.conn = conn
+
+    try:
+        yield conn, cursor
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _local.conn = None
+        close_db(conn)
+
+
+# Stable hash over the source fields of a row, used to skip rows that did not change
+def content_hash(*values):
+    data = json.dumps(values, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+# Diffs the local rows of table against the complete id set of the Shopware entity in one
+# statement: rows whose shopware_id is missing get is_in_shopware = 0, the others 1.
+# Returns the number of rows that are newly marked as removed.
+def diff_shopware_ids(table, shopware_ids, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS shopware_ids (shopware_id TEXT PRIMARY KEY)")
+        cursor.execute("DELETE FROM temp.shopware_ids")
+        cursor.executemany(
+            "INSERT OR IGNORE INTO temp.shopware_ids (shopware_id) VALUES (?)",
+            [(shopware_id,) for shopware_id in shopware_ids],
+        )
+
+        cursor.execute(f"""
+            SELECT COUNT(*) FROM {table}
+            WHERE is_in_shopware IS NOT 0
+            AND (shopware_id IS NULL OR shopware_id NOT IN (SELECT shopware_id FROM temp.shopware_ids))
+        """)
+        missing = cursor.fetchone()[0]
+
+        cursor.execute(f"""
+            UPDATE {table}
+            SET is_in_shopware = (shopware_id IS NOT NULL AND shopware_id IN (SELECT shopware_id FROM temp.shopware_ids))
+            WHERE is_in_shopware IS NOT (shopware_id IS NOT NULL AND shopware_id IN (SELECT shopware_id FROM temp.shopware_ids))
+        """)
+        cursor.execute("DELETE FROM temp.shopware_ids")
+
+        return missing
+
+
+# Reads a value stored with set_sync_state, None when it was never set
+def get_sync_state(key, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        cursor.execute("SELECT value FROM sync_state WHERE key = ?", (key,))
+        row = cursor.fetchone()
+
+        return row[0] if row is not None else None
+
+
+def set_sync_state(key, value, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        cursor.execute(
+            "INSERT INTO sync_state (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+
 # Function to create the database tables
 def create_tables():
     logging.info("Creating database tables")
@@ -104,3 +219,187 @@ def create_tables():
     conn.commit()
     logging.info("Database tables created")
     close_db(conn)
+
+
+# Merges rows sharing a shopware_id into the oldest row, points the given (table, column)
+# references at it and adds the unique index needed for ON CONFLICT (shopware_id) upserts
+def ensure_unique_shopware_id(cursor, table, references=()):
+    index = f"{table}_shopware_id_uindex"
+
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index,)
+    )
+    if cursor.fetchone() is not None:
+        return
+
+    duplicates = f"""
+        SELECT id FROM {table} t
+        WHERE shopware_id IS NOT NULL
+        AND id > (SELECT MIN(id) FROM {table} WHERE shopware_id = t.shopware_id)
+    """
+
+    # The kept row takes over the Inventree link of a newer duplicate, else the next sync
+    # would create the record in Inventree again
+    cursor.execute(f"""
+        UPDATE {table} SET
+            inventree_id = (
+                SELECT dup.inventree_id FROM {table} dup
+                WHERE dup.shopware_id = {table}.shopware_id AND dup.inventree_id IS NOT NULL
+                ORDER BY dup.id LIMIT 1
+            ),
+            is_in_inventree = 1
+        WHERE inventree_id IS NULL AND shopware_id IS NOT NULL
+        AND id = (SELECT MIN(id) FROM {table} WHERE shopware_id = {table}.shopware_id)
+        AND EXISTS (
+            SELECT 1 FROM {table} dup
+            WHERE dup.shopware_id = {table}.shopware_id AND dup.inventree_id IS NOT NULL
+        )
+    """)
+
+    for ref_table, column in references:
+        cursor.execute(f"""
+            UPDATE {ref_table} SET {column} = (
+                SELECT MIN(keep.id) FROM {table} dup
+                JOIN {table} keep ON keep.shopware_id = dup.shopware_id
+                WHERE dup.id = {ref_table}.{column}
+            )
+            WHERE {column} IN ({duplicates})
+        """)
+
+    cursor.execute(f"DELETE FROM {table} WHERE id IN ({duplicates})")
+
+    if cursor.rowcount > 0:
+        logging.warning(f"{cursor.rowcount} doppelte Einträge in {table} zusammengeführt")
+
+    cursor.execute(f"CREATE UNIQUE INDEX {index} ON {table} (shopware_id)")
+
+
+# Migration 1: tables the order and product sync read from, but which were never created
+def _create_mapping_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS modifier (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER,
+        multiplicator INTEGER,
+        "offset" INTEGER,
+        CONSTRAINT modifier_products_FK FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE ON UPDATE CASCADE
+        );
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS overwrites (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        item INTEGER,
+        overwrite_with INTEGER,
+        CONSTRAINT overwrites_item_FK FOREIGN KEY (item) REFERENCES products(id) ON DELETE CASCADE ON UPDATE CASCADE,
+        CONSTRAINT overwrites_overwrite_with_FK FOREIGN KEY (overwrite_with) REFERENCES products(id) ON DELETE CASCADE ON UPDATE CASCADE
+        );
+    """)
+
+
+# Migration 2: unique shopware_id on every synced table
+def _unique_shopware_ids(cursor):
+    ensure_unique_shopware_id(
+        cursor, "customers", [("addresses", "customer_id"), ("orders", "customer_id")]
+    )
+    ensure_unique_shopware_id(cursor, "addresses", [("orders", "address_id")])
+    ensure_unique_shopware_id(cursor, "orders", [("order_position", "order_id")])
+    ensure_unique_shopware_id(
+        cursor,
+        "products",
+        [
+            ("order_position", "product_id"),
+            ("modifier", "product_id"),
+            ("overwrites", "item"),
+            ("overwrites", "overwrite_with"),
+        ],
+    )
+
+
+# Migration 3: indexes for foreign keys and the sync filter columns
+def _lookup_indexes(cursor):
+    indexes = [
+        ("customers_email_index", "customers (email)"),
+        ("customers_sync_index", "customers (is_in_shopware, is_in_inventree)"),
+        ("addresses_customer_id_index", "addresses (customer_id)"),
+        ("addresses_sync_index", "addresses (is_in_shopware, is_in_inventree)"),
+        ("orders_customer_id_index", "orders (customer_id)"),
+        ("orders_address_id_index", "orders (address_id)"),
+        ("orders_sync_index", "orders (is_in_inventree)"),
+        ("products_sync_index", "products (is_in_shopware, is_in_inventree)"),
+        ("order_position_order_id_index", "order_position (order_id)"),
+        ("order_position_product_id_index", "order_position (product_id)"),
+        ("modifier_product_id_index", "modifier (product_id)"),
+        ("overwrites_item_index", "overwrites (item)"),
+    ]
+
+    for name, columns in indexes:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+
+
+# Migration 4: key/value store for sync cursors like high-water marks
+def _sync_state_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+        );
+    """)
+
+
+# Migration 5: content hash of the Shopware fields, and a flag for rows whose change
+# still has to be sent to Inventree
+def _content_hashes(cursor):
+    for table in ("customers", "addresses", "products"):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN content_hash TEXT")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN needs_update BOOLEAN DEFAULT 0")
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_needs_update_index ON {table} (needs_update)"
+        )
+
+
+# Schema migrations in the order they are applied, new migrations are appended with the next version
+MIGRATIONS = [
+    (1, "create modifier and overwrites tables", _create_mapping_tables),
+    (2, "unique shopware_id indexes", _unique_shopware_ids),
+    (3, "lookup indexes", _lookup_indexes),
+    (4, "sync state table", _sync_state_table),
+    (5, "content hashes", _content_hashes),
+]
+
+
+# Applies all migrations newer than the version recorded in the database, each in its own transaction
+def migrate():
+    conn, cursor = get_db()
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    current = cursor.fetchone()[0] or 0
+
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+
+        logging.info(f"Applying database migration {version}: {description}")
+
+        try:
+            cursor.execute("BEGIN")  # DDL is not wrapped in a transaction implicitly
+            migration(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            close_db(conn)
+            raise
+
+    close_db(conn)
@@ -0,0 +1,126 @@
+import threading
+from urllib.parse import quote
+
+from request import inventree_list, inventree_request
+from log_config import setup_logging
+
+logging = setup_logging()
+
+
+# In-memory index of the customer companies and addresses that already exist in Inventree.
+# Creates look the payload up first and link the existing record instead of POSTing a
+# duplicate, e.g. after a crash between the POST and the local update of inventree_id.
+# The customer and address syncs load the full lists for their pass and clear them after,
+# outside of a pass (e.g. for orders) a lookup asks Inventree for the one record instead.
+class CompanyIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.companies = None
+        self.addresses = None
+
+    @staticmethod
+    def company_key(data):
+        return (data["name"], data["email"])
+
+    @staticmethod
+    def address_key(data):
+        return (
+            str(data["company"]),
+            data["line1"],
+            data["line2"],
+            data["postal_code"],
+            data["postal_city"],
+        )
+
+    # Loads the customer companies from Inventree. If the list is incomplete the index is
+    # emptied, a stale index could link companies that were deleted in the meantime.
+    def load_companies(self):
+        companies = inventree_list("/api/company/", additions="is_customer=true")
+
+        if companies is None:
+            with self.lock:
+                self.companies = None
+            return
+
+        index = {}
+        for company in companies:
+            index.setdefault(self.company_key(company), company["pk"])
+
+        with self.lock:
+            self.companies = index
+
+        logging.info(f"{len(index)} Inventree Kunden geladen")
+
+    def load_addresses(self):
+        addresses = inventree_list("/api/company/address/")
+
+        if addresses is None:
+            with self.lock:
+                self.addresses = None
+            return
+
+        index = {}
+        for address in addresses:
+            index.setdefault(self.address_key(address), address["pk"])
+
+        with self.lock:
+            self.addresses = index
+
+        logging.info(f"{len(index)} Inventree Adressen geladen")
+
+    def clear_companies(self):
+        with self.lock:
+            self.companies = None
+
+    def clear_addresses(self):
+        with self.lock:
+            self.addresses = None
+
+    # pk of the company matching the payload, None if there is none
+    def company(self, data):
+        with self.lock:
+            if self.companies is not None:
+                return self.companies.get(self.company_key(data))
+
+        companies = inventree_request(
+            "get",
+            "/api/company/",
+            additions=f"is_customer=true&search={quote(data['name'])}",
+        )
+        return self._match(companies, self.company_key, self.company_key(data))
+
+    def address(self, data):
+        with self.lock:
+            if self.addresses is not None:
+                return self.addresses.get(self.address_key(data))
+
+        addresses = inventree_request(
+            "get", "/api/company/address/", additions=f"company={data['company']}"
+        )
+        return self._match(addresses, self.address_key, self.address_key(data))
+
+    # pk of the first record of a list response with the given key
+    @staticmethod
+    def _match(records, key, wanted):
+        if isinstance(records, dict):  # Paginated response
+            records = records.get("results")
+
+        for record in records or []:
+            if key(record) == wanted:
+                return record["pk"]
+
+        return None
+
+    # Records a created company, so a later create with the same payload links it
+    def add_company(self, data, pk):
+        with self.lock:
+            if self.companies is not None:
+                self.companies.setdefault(self.company_key(data), pk)
+
+    def add_address(self, data, pk):
+        with self.lock:
+            if self.addresses is not None:
+                self.addresses.setdefault(self.address_key(data), pk)
+
+
+company_index = CompanyIndex()
@@ -0,0 +1,113 @@
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = ",]}" + _WHITESPACE
+
+
+# Incrementally decodes a JSON object from an iterable of byte chunks. The array stored
+# under `key` is yielded element by element, every other top level value is collected
+# in `meta`. Only the current element and one chunk are kept in memory.
+class JsonArrayStream:
+    def __init__(self, chunks, key="data", on_close=None):
+        self.chunks = iter(chunks)
+        self.key = key
+        self.on_close = on_close
+        self.meta = {}
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    # Appends the next chunk and drops the part of the buffer that was already decoded
+    def _more(self):
+        if self._eof:
+            return False
+
+        chunk = next(self.chunks, None)
+
+        if chunk is None:
+            self._eof = True
+            rest = self._text.decode(b"", final=True)
+        else:
+            rest = self._text.decode(chunk)
+
+        self._buffer = self._buffer[self._pos :] + rest
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+
+            if not self._more():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r} at position {self._pos} of JSON stream")
+
+        self._pos += 1
+
+    def _value(self):
+        while True:
+            self._peek()
+
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._more():
+                    raise
+                continue
+
+            # A number is only complete once a delimiter follows it, "1." or "5e" at the end
+            # of a chunk decode as a shorter number and continue in the next chunk
+            is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+            if is_number and (end == len(self._buffer) or self._buffer[end] not in _DELIMITERS):
+                if self._more():
+                    continue
+
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        try:
+            self._expect("{")
+
+            if self._peek() == "}":
+                return
+
+            while True:
+                key = self._value()
+                self._expect(":")
+
+                if key == self.key and self._peek() == "[":
+                    self._pos += 1
+
+                    if self._peek() == "]":
+                        self._pos += 1
+                    else:
+                        while True:
+                            yield self._value()
+
+                            if self._peek() == "]":
+                                self._pos += 1
+                                break
+
+                            self._expect(",")
+                else:
+                    self.meta[key] = self._value()
+
+                if self._peek() == "}":
+                    return
+
+                self._expect(",")
+
+        finally:
+            if self.on_close is not None:
+                self.on_close()
@@ -4,7 +4,7 @@ import os
 #from dotenv import load_dotenv
 
 from auth import auth_job, check_tokens
-from db import create_tables
+from db import create_tables, migrate
 from customers import update_customers
 from addresses import update_addresses
 from log_config import setup_logging
@@ -18,9 +18,9 @@ logging = setup_logging()
 
 if os.path.exists("db/database.db"):
     logging.info("Database file found")
-else:
-    create_tables()
-    logging.info("Database file created")
+
+create_tables()
+migrate()  # Brings existing databases up to the current schema
 
 check_tokens()
 
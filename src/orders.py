@@ -1,14 +1,56 @@
 import json
+import math
+import os
+from datetime import datetime, timedelta, timezone
 
-from db import get_db, close_db
+from db import unit_of_work, get_sync_state, set_sync_state
 from customers import create_customer_db, create_customer_inventree
 from log_config import setup_logging
 from addresses import create_address_db, create_address_inventree
 
-from request import shopware_request, inventree_request
+from request import (
+    shopware_search,
+    shopware_search_stream,
+    inventree_request,
+    inventree_list,
+    build_criteria,
+    INVENTREE_PAGE_SIZE,
+    SHOPWARE_STREAM,
+)
+from workers import Paginator, StreamPaginator, run_parallel, INVENTREE_LINE_WORKERS
 
 logging = setup_logging()
 
+ORDER_PAGE_SIZE = int(os.getenv("ORDER_PAGE_SIZE", 100))  # Orders requested per page from Shopware
+ORDER_BACKFILL_DAYS = int(os.getenv("ORDER_BACKFILL_DAYS", 7))  # Days read when no order cursor exists yet
+ORDER_CURSOR_OVERLAP = int(os.getenv("ORDER_CURSOR_OVERLAP", 60))  # Minutes re-read before the cursor
+
+# Fields read from Shopware when importing orders
+ORDER_INCLUDES = {
+    "order": [
+        "id",
+        "orderNumber",
+        "orderDateTime",
+        "stateMachineState",
+        "orderCustomer",
+        "addresses",
+        "lineItems",
+        "deliveries",
+    ],
+    "state_machine_state": ["name"],
+    "order_customer": ["id", "firstName", "lastName", "email"],
+    "order_address": ["id", "firstName", "lastName", "street", "zipcode", "city"],
+    "order_line_item": ["productId", "quantity"],
+    "order_delivery": ["trackingCodes", "shippingDateEarliest"],
+}
+
+# Fields read from Shopware when comparing the order status
+ORDER_STATUS_INCLUDES = {
+    "order": ["id", "stateMachineState", "deliveries"],
+    "state_machine_state": ["name"],
+    "order_delivery": ["trackingCodes", "shippingDateEarliest"],
+}
+
 
 def update_orders():
     logging.info("Starte Bestellungen Update")
@@ -20,166 +62,210 @@ def update_orders():
     logging.info("Bestellungen Update abgeschlossen")
 
 
-# Adds Orders to the database
+# Adds new orders to the database. Orders are read in ascending orderDateTime from a cursor
+# stored in sync_state, so bursts of orders are paged through completely and idle passes only
+# fetch the overlap. Without a cursor the last ORDER_BACKFILL_DAYS are read.
 def update_orders_shopware():
-    conn, cursor = get_db()
+    counter_new = 0
+    counter = 0
 
-    order_count = 50  # Anzahl der Bestellungen, die rückläufig abgerufen werden sollen
+    with unit_of_work() as (conn, cursor):
+        cursor_value = get_sync_state("orders_cursor", conn)
 
-    orders, orders_total = shopware_request(
-        "get",
-        "/api/order",
-        page=1,
-        limit=order_count,
-        additions="sort=-orderDateTime&associations[addresses][]&associations[lineItems][]&associations[orderCustomer][]&associations[deliveries][]",
-    )
+        if cursor_value is None:
+            since = datetime.now(timezone.utc) - timedelta(days=ORDER_BACKFILL_DAYS)
+        else:
+            since = datetime.fromisoformat(cursor_value.replace("Z", "+00:00")) - timedelta(
+                minutes=ORDER_CURSOR_OVERLAP
+            )
 
-    counter_new = 0
-    product_counter = 0
+        since = since.astimezone(timezone.utc).isoformat(timespec="milliseconds")
+        latest = cursor_value
 
-    for order in orders:
-        cursor.execute(
-            """SELECT id FROM orders WHERE shopware_id = ?""", (order["id"],)
+        criteria = build_criteria(
+            limit=ORDER_PAGE_SIZE,
+            filters=[{"type": "range", "field": "orderDateTime", "parameters": {"gte": since}}],
+            sort=["orderDateTime", "id"],
+            associations=["addresses", "lineItems", "orderCustomer", "deliveries"],
+            includes=ORDER_INCLUDES,
+            total_count=True,
         )
 
-        if cursor.fetchone() is None:  # When order is not in database
-            try:
-                cursor.execute(
-                    """SELECT id FROM customers WHERE shopware_id = ?""",
-                    (order["orderCustomer"]["id"],),
-                )
-                customer_id = cursor.fetchone()[0]
+        if SHOPWARE_STREAM:  # Large pages, decoded record by record
+            pages = StreamPaginator(
+                lambda page: shopware_search_stream("order", dict(criteria, page=page)),
+                ORDER_PAGE_SIZE,
+            )
+        else:
+            pages = Paginator(
+                lambda page: shopware_search("order", dict(criteria, page=page), timeout=30),
+                ORDER_PAGE_SIZE,
+            )
+        products = product_resolution(conn)  # Loaded once for all line items of this pass
 
-            except TypeError:
-                logging.warning(
-                    f"Kunde {order['orderCustomer']['id']} nicht in Datenbank gefunden"
-                )
-                customer_id = None
-                pass
-
-            if customer_id is None:
-                data = {
-                    "inventree_id": None,
-                    "shopware_id": order["orderCustomer"]["id"],
-                    "is_in_shopware": True,
-                    "is_in_inventree": None,
-                    "firstName": order["orderCustomer"]["firstName"],
-                    "lastName": order["orderCustomer"]["lastName"],
-                    "email": order["orderCustomer"]["email"],
-                }
-
-                customer_id = create_customer_db(data)
+        for orders in pages:
+            cursor.execute(
+                "SELECT shopware_id FROM orders WHERE shopware_id IN (SELECT value FROM json_each(?))",
+                (json.dumps([order["id"] for order in orders]),),
+            )
+            existing = {row[0] for row in cursor.fetchall()}
 
-            try:
-                cursor.execute(
-                    """SELECT id FROM addresses WHERE shopware_id = ?""",
-                    (order["addresses"][0]["id"],),
-                )
-                address_id = cursor.fetchone()[0]
-            except TypeError:
-                logging.warning(
-                    f"Adresse {order['addresses'][0]['id']} nicht in Datenbank gefunden"
-                )
-                data = {
-                    "shopware_id": order["addresses"][0]["id"],
-                    "is_in_shopware": True,
-                    "customer_id": customer_id,
-                    "firstName": order["addresses"][0]["firstName"],
-                    "lastName": order["addresses"][0]["lastName"],
-                    "street": order["addresses"][0]["street"],
-                    "zipcode": order["addresses"][0]["zipcode"],
-                    "city": order["addresses"][0]["city"],
-                }
-                address_id = create_address_db(data)
+            for order in orders:
+                counter += 1
+
+                if latest is None or order["orderDateTime"] > latest:
+                    latest = order["orderDateTime"]
+
+                if order["id"] not in existing:
+                    # Todo: Update existing orders
+                    try:
+                        insert_order(order, conn, products)
+                        counter_new += 1
+                    except Exception as e:
+                        # A broken order is skipped, it must not block the cursor for good
+                        conn.rollback()
+                        logging.error(
+                            f"Bestellung {order.get('orderNumber')} konnte nicht gespeichert werden: {e}"
+                        )
+
+                # Orders are read in ascending order, so the cursor moves with every order
+                set_sync_state("orders_cursor", latest, conn)
+                conn.commit()
+
+        logging.info(
+            f"{counter_new} neue Bestellungen hinzugefügt, {counter} Bestellungen seit {since} verarbeitet"
+        )
+
+
+# Inserts a Shopware order with its positions, creates the customer and address if needed.
+# products is the map of product_resolution, it is loaded when not given.
+def insert_order(order, conn=None, products=None):
+    with unit_of_work(conn) as (conn, cursor):
+        if products is None:
+            products = product_resolution(conn)
+
+        try:
+            cursor.execute(
+                """SELECT id FROM customers WHERE shopware_id = ?""",
+                (order["orderCustomer"]["id"],),
+            )
+            customer_id = cursor.fetchone()[0]
+
+        except TypeError:
+            logging.warning(
+                f"Kunde {order['orderCustomer']['id']} nicht in Datenbank gefunden"
+            )
+            customer_id = None
+            pass
+
+        if customer_id is None:
+            data = {
+                "inventree_id": None,
+                "shopware_id": order["orderCustomer"]["id"],
+                "is_in_shopware": True,
+                "is_in_inventree": None,
+                "firstName": order["orderCustomer"]["firstName"],
+                "lastName": order["orderCustomer"]["lastName"],
+                "email": order["orderCustomer"]["email"],
+            }
+
+            customer_id = create_customer_db(data, conn)
+
+        try:
+            cursor.execute(
+                """SELECT id FROM addresses WHERE shopware_id = ?""",
+                (order["addresses"][0]["id"],),
+            )
+            address_id = cursor.fetchone()[0]
+        except TypeError:
+            logging.warning(
+                f"Adresse {order['addresses'][0]['id']} nicht in Datenbank gefunden"
+            )
+            data = {
+                "shopware_id": order["addresses"][0]["id"],
+                "is_in_shopware": True,
+                "customer_id": customer_id,
+                "firstName": order["addresses"][0]["firstName"],
+                "lastName": order["addresses"][0]["lastName"],
+                "street": order["addresses"][0]["street"],
+                "zipcode": order["addresses"][0]["zipcode"],
+                "city": order["addresses"][0]["city"],
+            }
+            address_id = create_address_db(data, conn)
+
+        cursor.execute(
+            """INSERT INTO orders (shopware_id, is_in_shopware, shopware_order_number, creation_date, customer_id, state, address_id) 
+            VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id""",
+            (
+                order["id"],
+                True,
+                order["orderNumber"],
+                order["orderDateTime"],
+                customer_id,
+                order["stateMachineState"]["name"],
+                address_id,
+            ),
+        )
+
+        order_id = cursor.fetchone()[0]
 
+        if order["deliveries"]:
             cursor.execute(
-                """INSERT INTO orders (shopware_id, is_in_shopware, shopware_order_number, creation_date, customer_id, state, address_id) 
-                VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id""",
+                """UPDATE orders SET
+                           shippment_number = ?,
+                           shipping_date = ?,
+                           shipped = ?
+                           WHERE id = ?""",
                 (
-                    order["id"],
-                    True,
-                    order["orderNumber"],
-                    order["orderDateTime"],
-                    customer_id,
-                    order["stateMachineState"]["name"],
-                    address_id,
+                    str(order["deliveries"][0]["trackingCodes"]),
+                    order["deliveries"][0]["shippingDateEarliest"],
+                    bool(order["deliveries"][0]["trackingCodes"]),
+                    order_id,
                 ),
             )
 
-            order_id = cursor.fetchone()[0]
-
-            if order["deliveries"] is not None:
-                cursor.execute(
-                    """UPDATE orders SET
-                               shippment_number = ?,
-                               shipping_date = ?,
-                               shipped = ?
-                               WHERE id = ?""",
-                    (
-                        str(order["deliveries"][0]["trackingCodes"]),
-                        order["deliveries"][0]["shippingDateEarliest"],
-                        bool(order["deliveries"][0]["trackingCodes"]),
-                        order_id,
-                    ),
-                )
-                conn.commit()
+        positions = []
 
-            for item in order["lineItems"]:
-                cursor.execute(
-                    """SELECT id FROM products WHERE shopware_id = ?""",
-                    (item["productId"],),
+        for item in order["lineItems"]:
+            try:
+                product_id, multiplicator, offset = products[item["productId"]]
+            except KeyError:
+                logging.warning(
+                    f"Produkt {item['productId']} nicht in Datenbank gefunden"
                 )
-                try:
-                    product_id = cursor.fetchone()[0]
-                except TypeError:
-                    logging.warning(
-                        f"Produkt {item['productId']} nicht in Datenbank gefunden"
-                    )
-                    continue
+                continue
 
-                cursor.execute(
-                    """SELECT multiplicator, offset FROM modifier WHERE product_id = ?""",
-                    (product_id,),
-                )
+            quantity = item["quantity"]
+            if multiplicator is not None and offset is not None:
+                quantity = quantity * multiplicator + offset
 
-                try:
-                    modifier = cursor.fetchone()
-                    item["quantity"] = item["quantity"] * modifier[0] + modifier[1]
-                except TypeError:
-                    pass
-
-                cursor.execute(
-                    """  SELECT p.id
-                                    FROM overwrites o
-                                    JOIN products p ON o.overwrite_with = p.id
-                                    WHERE o.item = ?
-                                    """,
-                    (product_id,),
-                )  # Check if product is overwritten
-
-                try:
-                    product_id = cursor.fetchone()[0]
-                except TypeError:
-                    pass
-
-                cursor.execute(
-                    """INSERT INTO order_position (product_id, order_id, count) VALUES (?, ?, ?)""",
-                    (product_id, order_id, item["quantity"]),
-                )
+            positions.append((product_id, order_id, quantity))
 
-                product_counter += 1
+        cursor.executemany(
+            """INSERT INTO order_position (product_id, order_id, count) VALUES (?, ?, ?)""",
+            positions,
+        )
 
-            counter_new += 1
 
-            conn.commit()
+# Maps the shopware_id of every product to (product id, multiplicator, offset). The modifier
+# belongs to the ordered product, the id is replaced by its overwrite if there is one.
+def product_resolution(conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        cursor.execute("""
+            SELECT p.shopware_id, COALESCE(target.id, p.id), m.multiplicator, m."offset"
+            FROM products p
+            LEFT JOIN modifier m ON m.product_id = p.id
+            LEFT JOIN overwrites o ON o.item = p.id
+            LEFT JOIN products target ON target.id = o.overwrite_with
+            WHERE p.shopware_id IS NOT NULL
+            ORDER BY p.id, m.id, o.id
+        """)
 
-        else:
-            continue
-            # Todo: Update existing orders
+        products = {}
+        for shopware_id, product_id, multiplicator, offset in cursor.fetchall():
+            products.setdefault(shopware_id, (product_id, multiplicator, offset))
 
-    logging.info(
-        f"{counter_new} neue Bestellungen hinzugefügt, insgesamt {orders_total} Bestellungen Verarbeitet"
-    )
+        return products
 
 
 # Updates the status of the orders
@@ -197,109 +283,75 @@ def update_order_status():
             logging.error(f"Unerwarteter Bestellstatus: {state}")
             return None
 
-    conn, cursor = get_db()
-
-    cursor.execute(
-        """SELECT inventree_id, shopware_id, inventree_state FROM orders WHERE state != 'Abgeschlossen' OR inventree_state IS NULL OR inventree_state != 'Complete'"""
-    )
-    orders = cursor.fetchall()
-
-    for order in orders:
-        if order[0] is None:
-            continue
-
-        response = shopware_request(
-            "get",
-            f"/api/order/{order[1]}",
-            additions="associations[stateMachineState][]&associations[deliveries][]",
+    with unit_of_work() as (conn, cursor):
+        cursor.execute(
+            """SELECT inventree_id, shopware_id, inventree_state FROM orders WHERE state != 'Abgeschlossen' OR inventree_state IS NULL OR inventree_state != 'Complete'"""
         )
-        state_shopware = response["stateMachineState"]["name"]
+        orders = cursor.fetchall()
 
-        response = inventree_request("get", f"/api/order/so/{order[0]}/")
-        state_inventree = response["status_text"]
+        for order in orders:
+            if order[0] is None:
+                continue
 
-        state_inventree = interpret_state(state_inventree)
-        state_shopware = interpret_state(state_shopware)
+            response = shopware_search(
+                "order",
+                build_criteria(
+                    ids=[order[1]],
+                    associations=["stateMachineState", "deliveries"],
+                    includes=ORDER_STATUS_INCLUDES,
+                ),
+            )
 
-        if state_shopware == state_inventree:
-            continue
-        elif state_shopware > state_inventree:
-            if state_inventree == 1:
-                response = inventree_request("post", f"/api/order/so/{order[0]}/issue/")
-
-                if response is not None:
-                    cursor.execute(
-                        """UPDATE orders SET inventree_state = 'In Progress' WHERE shopware_id = ?""",
-                        (order[1],),
-                    )
-                    conn.commit()
-                    continue
-                else:
-                    continue
-
-            elif state_inventree == 2:
-                try:
-                    cursor.execute(
-                        """UPDATE orders SET
-                                shippment_number = ?
-                                shipping_date = ?
-                                shipped = ? 
-                                WHERE shopware_id = ?""",
-                        (
-                            response["deliveries"][0]["trackingCodes"],
-                            response["deliveries"][0]["shippingDateEarliest"],
-                            bool(response["deliveries"][0]["trackingCodes"]),
-                            order[1],
-                        ),
-                    )
-                    conn.commit()
-                except KeyError:
-                    pass
+            if response is None or not response[0]:
+                logging.error(f"Bestellung {order[1]} nicht in Shopware gefunden")
+                continue
 
-                response = inventree_request(
-                    "post", f"/api/order/so/{order[0]}/complete/"
-                )
+            response = response[0][0]
+            state_shopware = response["stateMachineState"]["name"]
 
-                if response is not None:
-                    cursor.execute(
-                        """UPDATE orders SET inventree_state = 'Complete' WHERE shopware_id = ?""",
-                        (order[1],),
-                    )
-                    conn.commit()
-                    continue
-                else:
-                    order_info = inventree_request("get", f"/api/order/so/{order[0]}/")
+            response = inventree_request("get", f"/api/order/so/{order[0]}/")
+            state_inventree = response["status_text"]
 
-                    try:
-                        items = order_info["line_items"]
-                        done_items = order_info["completed_lines"]
-                    except KeyError:
-                        continue
+            state_inventree = interpret_state(state_inventree)
+            state_shopware = interpret_state(state_shopware)
+
+            if state_shopware == state_inventree:
+                continue
+            elif state_shopware > state_inventree:
+                if state_inventree == 1:
+                    response = inventree_request("post", f"/api/order/so/{order[0]}/issue/")
 
-                    if items != done_items:
-                        logging.debug(
-                            f"Bestellung {order[0]} noch nicht vollständig abgeschlossen"
+                    if response is not None:
+                        cursor.execute(
+                            """UPDATE orders SET inventree_state = 'In Progress' WHERE shopware_id = ?""",
+                            (order[1],),
                         )
+                        conn.commit()
+                        continue
+                    else:
                         continue
 
-                    shipment_id = inventree_request(
-                        "get",
-                        "/api/order/so/shipment/",
-                        additions=f"order={order[0]}",
-                        page=1,
-                        limit=10,
-                    )
-
+                elif state_inventree == 2:
                     try:
-                        shipment_id = shipment_id["results"][0]["pk"]
-                    except KeyError:
-                        logging.error(
-                            f"Keine offene Lieferung für Bestellung {order[0]} gefunden"
+                        cursor.execute(
+                            """UPDATE orders SET
+                                    shippment_number = ?
+                                    shipping_date = ?
+                                    shipped = ? 
+                                    WHERE shopware_id = ?""",
+                            (
+                                response["deliveries"][0]["trackingCodes"],
+                                response["deliveries"][0]["shippingDateEarliest"],
+                                bool(response["deliveries"][0]["trackingCodes"]),
+                                order[1],
+                            ),
                         )
-                        continue
+                        conn.commit()
+                    except KeyError:
+                        pass
 
                     response = inventree_request(
-                        "post", f"/api/order/so/shipment/{shipment_id}/ship/"
+                        "post", f"/api/order/so/{order[0]}/complete/"
                     )
 
                     if response is not None:
@@ -310,219 +362,375 @@ def update_order_status():
                         conn.commit()
                         continue
                     else:
-                        logging.error(
-                            f"Bestellung {order[0]} konnte nicht abgeschlossen werden, bitte manuell prüfen"
+                        order_info = inventree_request("get", f"/api/order/so/{order[0]}/")
+
+                        try:
+                            items = order_info["line_items"]
+                            done_items = order_info["completed_lines"]
+                        except KeyError:
+                            continue
+
+                        if items != done_items:
+                            logging.debug(
+                                f"Bestellung {order[0]} noch nicht vollständig abgeschlossen"
+                            )
+                            continue
+
+                        shipment_id = inventree_request(
+                            "get",
+                            "/api/order/so/shipment/",
+                            additions=f"order={order[0]}",
+                            page=1,
+                            limit=10,
                         )
-                        continue
+
+                        try:
+                            shipment_id = shipment_id["results"][0]["pk"]
+                        except KeyError:
+                            logging.error(
+                                f"Keine offene Lieferung für Bestellung {order[0]} gefunden"
+                            )
+                            continue
+
+                        response = inventree_request(
+                            "post", f"/api/order/so/shipment/{shipment_id}/ship/"
+                        )
+
+                        if response is not None:
+                            cursor.execute(
+                                """UPDATE orders SET inventree_state = 'Complete' WHERE shopware_id = ?""",
+                                (order[1],),
+                            )
+                            conn.commit()
+                            continue
+                        else:
+                            logging.error(
+                                f"Bestellung {order[0]} konnte nicht abgeschlossen werden, bitte manuell prüfen"
+                            )
+                            continue
+                else:
+                    logging.error(
+                        f"Unerwarteter Bestellstatus, Inventree: {state_inventree}"
+                    )
             else:
                 logging.error(
-                    f"Unerwarteter Bestellstatus, Inventree: {state_inventree}"
+                    f"Unerwarteter Bestellstatus Kombination: Shopware: {state_shopware}, Inventree: {state_inventree}"
                 )
-        else:
-            logging.error(
-                f"Unerwarteter Bestellstatus Kombination: Shopware: {state_shopware}, Inventree: {state_inventree}"
-            )
 
 
-# Synchronizes the orders with Inventree
+# Synchronizes the orders with Inventree. Missing customers and addresses are created first,
+# one at a time, so two orders of a new customer can not create it twice. The orders are
+# independent after that and are created on the Inventree worker pool.
 def sync_orders_inventree():
-    conn, cursor = get_db()
-
-    # cursor.execute(
-    #    """SELECT shopware_order_number, creation_date, customer_id, address_id, id FROM orders WHERE is_in_inventree = 0 OR is_in_inventree IS NULL"""
-    # )
-    # orders = cursor.fetchall()
-
-    # Get all open orders, with the needed information from database
-    cursor.execute("""  SELECT orders.shopware_order_number, orders.creation_date, customers.inventree_id, customers.id, addresses.inventree_id, addresses.id, orders.id,
-                        (
-                            SELECT json_group_array(
-                                json_object('id', products.inventree_id, 'count', order_position.count)
-                            )
-                            FROM order_position
-                            JOIN products ON order_position.product_id = products.id
-                            WHERE order_position.order_id = orders.id
-                        ) AS bestellpositionen
-                        FROM orders
-                        JOIN customers ON orders.customer_id = customers.id
-                        JOIN addresses ON orders.address_id = addresses.id
-                        WHERE orders.is_in_inventree = 0 OR orders.is_in_inventree IS NULL;
-                   """)
-    orders = cursor.fetchall()
-
-    # 0: shopware_order_number
-    # 1: creation_date
-    # 2: customer_inventree_id
-    # 3: customer_id
-    # 4: address_inventree_id
-    # 5: address_id
-    # 6: order_id
-    # 7: order positions as json
-    #   0: inventree_product_id
-    #   1: quantity
+    with unit_of_work() as (conn, cursor):
+        # Get all open orders, with the needed information from database
+        cursor.execute("""  SELECT orders.shopware_order_number, orders.creation_date, customers.inventree_id, customers.id, addresses.inventree_id, addresses.id, orders.id,
+                            (
+                                SELECT json_group_array(
+                                    json_object('id', products.inventree_id, 'count', order_position.count)
+                                )
+                                FROM order_position
+                                JOIN products ON order_position.product_id = products.id
+                                WHERE order_position.order_id = orders.id
+                            ) AS bestellpositionen
+                            FROM orders
+                            JOIN customers ON orders.customer_id = customers.id
+                            JOIN addresses ON orders.address_id = addresses.id
+                            WHERE orders.is_in_inventree = 0 OR orders.is_in_inventree IS NULL;
+                       """)
+        orders = cursor.fetchall()
+
+        # 0: shopware_order_number
+        # 1: creation_date
+        # 2: customer_inventree_id
+        # 3: customer_id
+        # 4: address_inventree_id
+        # 5: address_id
+        # 6: order_id
+        # 7: order positions as json
+        #   0: inventree_product_id
+        #   1: quantity
+
+        customer_ids = {}
+        address_ids = {}
+        ready = []
+
+        for order in orders:
+            if order[2] is not None:
+                customer_ids[order[3]] = order[2]
+            elif order[3] not in customer_ids:  # If customer is not in Inventree
+                logging.warning(f"Kunde {order[3]} ist noch nicht in Inventree")
+                customer_ids[order[3]] = create_customer_inventree(order[3], conn)
+
+                if customer_ids[order[3]] is None:
+                    logging.error(
+                        f"Kunde {order[3]} konnte nicht in Inventree erstellt werden"
+                    )
 
-    counter = 0
-    product_counter = 0
+            if order[4] is not None:
+                address_ids[order[5]] = order[4]
+            elif order[5] not in address_ids:  # If address is not in Inventree
+                logging.warning(f"Adresse {order[5]} ist noch nicht in Inventree")
+                address_ids[order[5]] = create_address_inventree(order[5], conn)
 
-    for order in orders:
-        creation_date = order[1].split("T")[0]
+                if address_ids[order[5]] is None:
+                    logging.error(
+                        f"Adresse {order[5]} konnte nicht in Inventree erstellt werden"
+                    )
 
-        if order[2] is None:  # If customer is not in Inventree
-            logging.warning(f"Kunde {order[3]} ist noch nicht in Inventree")
-            customer_id = create_customer_inventree(order[3])
+            conn.commit()
 
-            if customer_id is None:
-                logging.error(
-                    f"Kunde {order[3]} konnte nicht in Inventree erstellt werden"
-                )
+            if customer_ids[order[3]] is None or address_ids[order[5]] is None:
                 continue
-        else:
-            customer_id = order[2]
-
-        if order[4] is None:  # If address is not in Inventree
-            logging.warning(f"Adresse {order[5]} ist noch nicht in Inventree")
-            address_id = create_address_inventree(order[5])
 
-            if address_id is None:
-                logging.error(
-                    f"Adresse {order[5]} konnte nicht in Inventree erstellt werden"
+            ready.append(
+                (
+                    order[0],
+                    order[1],
+                    customer_ids[order[3]],
+                    address_ids[order[5]],
+                    order[6],
+                    json.loads(order[7]),
                 )
-                continue
-        else:
-            address_id = order[4]
-
-        reference = f"SO-{''.join(filter(str.isdigit, order[0]))}"
+            )
 
-        data = {
-            "creation_date": creation_date,
-            "customer_reference": order[0],
-            "address": address_id,
-            "customer": customer_id,
-            "reference": reference,
-            "order_currency": "EUR",
-        }
+        counter = 0
+        product_counter = 0
+        created = {}
 
-        response = inventree_request(
-            "post", "/api/order/so/", data=data
-        )  # Create order in Inventree
+        for order, result in run_parallel(post_order_inventree, ready):
+            if result is None:
+                continue
 
-        try:
-            order_inventree_id = response["pk"]  # Get the order id from the response
-        except TypeError:
-            logging.error(
-                f"Bestellung {order[0]} konnte nicht in Inventree erstellt werden"
-            )
-            continue
+            order_inventree_id, lines = result
 
-        if response is not None:
-            cursor.execute(  # Update the order in the database
+            # Written back right away, an order created in Inventree but not linked here
+            # would be posted again next pass and rejected for its duplicate reference
+            cursor.execute(
                 """UPDATE orders SET is_in_inventree = 1, inventree_id = ? WHERE id = ?""",
-                (order_inventree_id, order[6]),
+                (order_inventree_id, order[4]),
             )
             conn.commit()
+
+            created[order[4]] = (order_inventree_id, lines)
+            counter += 1
+            product_counter += len(order[5])
+
+        logging.info(
+            f"{counter} Bestellungen mit {product_counter} Produkten in Inventree synchronisiert"
+        )
+
+        # Stock is only planned for created orders, in the order they were read, so a failed
+        # order holds nothing back from the later ones. The workers only submit the plan.
+        allocations = []
+        stock = load_stock_inventree(
+            {product_item["id"] for _, lines in created.values() for product_item, _ in lines}
+        )
+
+        for order in ready:
+            if order[4] not in created:
+                continue
+
+            order_inventree_id, lines = created[order[4]]
+            items = plan_allocations(lines, stock)
+
+            if items:
+                allocations.append((order_inventree_id, items))
+
+        for _ in run_parallel(lambda allocation: allocate_order_inventree(*allocation), allocations):
+            pass
+
+
+# Creates an order row (order_number, creation_date, customer, address, id, positions) with
+# its lines in Inventree. Runs on a worker thread, so it does not touch the database.
+# Returns (inventree_id, [(position, line pk), ...]) or None if the order could not be created.
+def post_order_inventree(order):
+    creation_date = order[1].split("T")[0]
+    reference = f"SO-{''.join(filter(str.isdigit, order[0]))}"
+
+    data = {
+        "creation_date": creation_date,
+        "customer_reference": order[0],
+        "address": order[3],
+        "customer": order[2],
+        "reference": reference,
+        "order_currency": "EUR",
+    }
+
+    response = inventree_request(
+        "post", "/api/order/so/", data=data
+    )  # Create order in Inventree
+
+    try:
+        order_inventree_id = response["pk"]  # Get the order id from the response
+    except TypeError:
+        logging.error(
+            f"Bestellung {order[0]} konnte nicht in Inventree erstellt werden"
+        )
+        return None
+
+    # The lines are created concurrently, their pk is taken from the POST responses
+    lines = [
+        (product_item, line_id)
+        for product_item, line_id in run_parallel(
+            lambda product_item: post_order_line_inventree(order_inventree_id, product_item),
+            order[5],
+            INVENTREE_LINE_WORKERS,
+        )
+    ]
+
+    if any(line_id is None for _, line_id in lines):
+        lines = find_order_lines_inventree(order_inventree_id, lines)
+
+    found = []
+
+    for product_item, line_id in lines:
+        if line_id is None:
+            logging.warning(f"Keine Bestellposition für Teil {product_item['id']} gefunden")
         else:
-            continue
+            found.append((product_item, line_id))
 
-        products = json.loads(order[7])
+    return order_inventree_id, found
 
-        for product_item in products:  # Add the products to the order
-            part = product_item["id"]
-            quantity = product_item["count"]
 
-            data = {
-                "order": order_inventree_id,
-                "part": part,
-                "quantity": quantity,
-                "sale_price_currency": "EUR",
-            }
+# Adds a position {"id": part, "count": quantity} to an Inventree order, returns the line pk
+def post_order_line_inventree(order_inventree_id, product_item):
+    data = {
+        "order": order_inventree_id,
+        "part": product_item["id"],
+        "quantity": product_item["count"],
+        "sale_price_currency": "EUR",
+    }
+
+    response = inventree_request(
+        "post", "/api/order/so-line/", data=data
+    )  # Add product to order
+
+    try:
+        return response["pk"]
+    except (TypeError, KeyError):
+        return None
+
+
+# Fills in the missing line pks of [(product_item, line_id)] from one list of the order lines,
+# for lines whose POST response got lost
+def find_order_lines_inventree(order_inventree_id, lines):
+    order_lines = inventree_list("/api/order/so-line/", additions=f"order={order_inventree_id}")
+
+    if order_lines is None:
+        return lines
+
+    known = {line_id for _, line_id in lines if line_id is not None}
+    result = []
+
+    for product_item, line_id in lines:
+        if line_id is None:
+            for item in order_lines:
+                if item["pk"] not in known and str(item["part"]) == str(product_item["id"]):
+                    line_id = item["pk"]
+                    known.add(line_id)
+                    break
+
+        result.append((product_item, line_id))
+
+    return result
+
+
+# Loads the available stock items of the given parts. Small batches send one filtered request
+# per part, concurrently; only when there are more parts than pages of the whole available
+# stock list is that list read instead. Returns a ledger {part: [[stock item pk, unallocated
+# quantity], ...]} that plan_allocations draws from.
+def load_stock_inventree(parts):
+    parts = {str(part) for part in parts}
+    stock = {}
+
+    if not parts:
+        return stock
+
+    count = inventree_request("get", "/api/stock/", additions="available=true&limit=1")
+
+    if count is not None and len(parts) > math.ceil(count["count"] / INVENTREE_PAGE_SIZE):
+        items = inventree_list("/api/stock/", additions="available=true")
 
-            response = inventree_request(
-                "post", "/api/order/so-line/", data=data
-            )  # Add product to order
+        if items is None:
+            logging.warning("Lagerbestand konnte nicht geladen werden, Bestellungen werden nicht zugewiesen")
+            return stock
+    else:
+        items = []
 
-            product_counter += 1
+        for part, part_items in run_parallel(
+            lambda part: inventree_request("get", "/api/stock/", additions=f"available=true&part={part}"),
+            parts,
+        ):  # Check if product is in stock
+            items.extend(part_items or [])
 
-            order_items_id = inventree_request(
-                "get",
-                "/api/order/so-line/",
-                additions=f"order={order_inventree_id}",
-                page=1,
-                limit=100,
+    for item in items:
+        part = str(item["part"])
+
+        if part in parts:
+            stock.setdefault(part, []).append(
+                [item["pk"], item["quantity"] - (item.get("allocated") or 0)]
             )
 
-            try:
-                order_items_id = order_items_id["results"][0]
-            except KeyError:
-                logging.warning(
-                    f"Keine Bestellpositionen für Bestellung {order_inventree_id} gefunden"
-                )
-                continue
+    for part in parts - stock.keys():
+        logging.warning(f"Kein Lagerbestand für Produkt {part} gefunden")
 
-            order_item_id = None
-            try:
-                for item in order_items_id:
-                    if item["part"] == part:
-                        order_item_id = item["pk"]
-                        break
-            except TypeError:
-                order_item_id = order_items_id["pk"]
-
-            if order_item_id is None:
-                logging.warning(f"Keine Bestellposition für Teil {part} gefunden")
-                continue
+    return stock
 
-            stock = inventree_request(
-                "get",
-                "/api/stock/",
-                additions=f"available=true&part={part}",
-            )  # Check if product is in stock
 
-            try:
-                if stock is None:
-                    logging.warning(f"Kein Lagerbestand für Produkt {part} gefunden")
-                    continue
-
-                if stock[0]["quantity"] < quantity:
-                    logging.warning(f"Produkt {part} nicht genügend Lagerbestand")
-                    continue
-            except IndexError:
-                logging.warning(f"Kein Lagerbestand für Produkt {part} gefunden")
-                continue
+# Plans the allocation of the order lines [(position, line pk), ...] from the stock ledger and
+# returns the allocate items. A position is spread over as many stock items as needed;
+# positions that can not be covered completely are skipped and leave the ledger untouched.
+def plan_allocations(lines, stock):
+    allocation = []
 
-            shipment = inventree_request(
-                "get",
-                "/api/order/so/shipment/",
-                additions=f"shiped=false&order={order_inventree_id}",
-                page=1,
-                limit=10,
-            )  # Search for open shipment
+    for product_item, line_id in lines:
+        items = stock.get(str(product_item["id"]), [])
+        quantity = product_item["count"]
 
-            try:
-                shipment_id = shipment["results"][0]["pk"]
-            except KeyError:
-                logging.error(
-                    f"Keine offene Lieferung für Bestellung {order_inventree_id} gefunden, bitte manuell prüfen"
-                )
+        if sum(max(item[1], 0) for item in items) < quantity:
+            if items:
+                logging.warning(f"Produkt {product_item['id']} nicht genügend Lagerbestand")
+            continue
+
+        for item in items:
+            if quantity <= 0:
+                break
+
+            take = min(item[1], quantity)
+            if take <= 0:
                 continue
 
-            data = {
-                "items": [
-                    {
-                        "line_item": order_item_id,
-                        "quantity": quantity,
-                        "stock_item": stock[0]["pk"],
-                    }
-                ],
-                "shipment": shipment_id,
-            }
+            item[1] -= take
+            quantity -= take
+            allocation.append({"line_item": line_id, "quantity": take, "stock_item": item[0]})
+
+    return allocation
+
 
-            response = inventree_request(
-                "post", f"/api/order/so/{order_inventree_id}/allocate/", data=data
-            )  # Alocate stock to order
+# Allocates the stock items to the lines of an order in the open shipment
+def allocate_order_inventree(order_inventree_id, items):
+    shipment = inventree_request(
+        "get",
+        "/api/order/so/shipment/",
+        additions=f"shiped=false&order={order_inventree_id}",
+        page=1,
+        limit=10,
+    )  # Search for open shipment
+
+    try:
+        shipment_id = shipment["results"][0]["pk"]
+    except (TypeError, KeyError, IndexError):
+        logging.error(
+            f"Keine offene Lieferung für Bestellung {order_inventree_id} gefunden, bitte manuell prüfen"
+        )
+        return
 
-        counter += 1
+    data = {
+        "items": items,
+        "shipment": shipment_id,
+    }
 
-    close_db(conn)
-    logging.info(
-        f"{counter} Bestellungen mit {product_counter} Produkten in Inventree synchronisiert"
-    )
+    inventree_request(
+        "post", f"/api/order/so/{order_inventree_id}/allocate/", data=data
+    )  # Alocate stock to order
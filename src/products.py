@@ -1,18 +1,34 @@
-import os
-import requests
 import json
+import requests
 
 
-from db import get_db, close_db
+from db import unit_of_work, content_hash, diff_shopware_ids
 from log_config import setup_logging
+from request import (
+    shopware_client,
+    inventree_request,
+    inventree_list,
+    shopware_ids,
+    shopware_search_stream,
+    build_criteria,
+    SHOPWARE_PAGE_SIZE,
+    SHOPWARE_STREAM,
+)
+from workers import Paginator, StreamPaginator, run_parallel, Batch
 
 logging = setup_logging()
 
+# Fields read from Shopware for the products table, variants are included as children
+PRODUCT_INCLUDES = {
+    "product": ["id", "name", "description", "active", "productNumber", "children"],
+}
+
 
 def update_products():
     logging.info("Starte Produkt Update")
     
     update_products_shopware()
+    valid_shopware_product()
     sync_inventree()
     
     logging.info("Produkt Update abgeschlossen")
@@ -20,31 +36,26 @@ def update_products():
 
 # updates product db from shopware
 def update_products_shopware():
-    base_url = os.getenv("SHOPWARE_URL")
-
-    limit = 50
-    page = 1
+    limit = SHOPWARE_PAGE_SIZE
     counter = 0
+    counter_new = 0
     count_update = 0
 
+    criteria = build_criteria(
+        limit=limit,
+        sort=["id"],  # Unique order, offset pages must not shift between requests
+        associations=["children"],
+        includes=PRODUCT_INCLUDES,
+        total_count=True,
+    )
+
     def request(page, limit):
         try:
-            # Token bei jedem Request neu einlesen
-            with open("auth.json", "r") as f:
-                auth_data = json.load(f)
-
-            access_token = auth_data["shopware_token"]
-
-            auth_headers = {
-                "Accept": "application/json",
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            }
-
-            response = requests.get(
-                f"{base_url}/api/product?limit={limit}&page={page}&associations[children][]",
-                headers=auth_headers,
-                timeout=10,  # 10 Sekunden Timeout
+            response = shopware_client.send(
+                "post",
+                "/api/search/product",
+                json=dict(criteria, page=page),
+                timeout=30,  # Large pages with variants take a while
             )
 
             if response.status_code != 200:
@@ -69,310 +80,298 @@ def update_products_shopware():
             logging.error(f"Error: {e}")
             return None
 
-    conn, cursor = get_db()
-
-    while True:
-        products, product_count = request(page, limit)
-
-        if products is None:
-            break
-
-        for product in products:                
-            if product["name"] is None:
-                logging.warning(f"Produkt hat keinen Namen, produktNumber: {product['productNumber']}")
-                continue
-                
-            if product["children"] is not None:
-                
-                for child in product["children"]:
-                    
-                    if child["name"] is None:
-                        logging.warning(f"Produkt hat keinen Namen, produktNumber: {child['productNumber']}")
-                        child["name"] = child["productNumber"]
-
-                    cursor.execute(
-                        """
-                        SELECT * FROM products WHERE shopware_id = ?
-                    """,
-                        (child["id"],),
-                    )
-
-                    if cursor.fetchone() is None:
-                        cursor.execute(
-                            """
-                            INSERT INTO products (shopware_id, name, description, is_in_shopware, active, productNumber)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                        """,
-                            (
-                                child["id"],
-                                child["name"],
-                                child["description"],
-                                True,
-                                child["active"],
-                                child["productNumber"],
-                            ),
-                        )
-                        count_update += 1
-                    else:
-                        cursor.execute(
-                            """
-                            UPDATE products
-                            SET name = ?, description = ?, active = ?, productNumber = ?
-                            WHERE shopware_id = ?
-                        """,
-                            (
-                                child["name"],
-                                child["description"],
-                                child["active"],
-                                child["productNumber"],
-                                child["id"],
-                            ),
-                        )
-                        count_update += 1
-
-                    counter += 1
-                    conn.commit()
-
-            cursor.execute(
-                """
-                SELECT * FROM products WHERE shopware_id = ?
-            """,
-                (product["id"],),
+    with unit_of_work() as (conn, cursor):
+        if SHOPWARE_STREAM:  # Large pages, decoded record by record
+            pages = StreamPaginator(
+                lambda page: shopware_search_stream("product", dict(criteria, page=page)),
+                limit,
             )
+        else:
+            pages = Paginator(lambda page: request(page, limit), limit)  # Pages are fetched ahead
 
-            if cursor.fetchone() is None:
-                cursor.execute(
-                    """
-                    INSERT INTO products (shopware_id, name, description, is_in_shopware, active, productNumber)
-                    VALUES (?, ?, ?, ?, ?)
-                """,
-                    (
-                        product["id"],
-                        product["name"],
-                        product["description"],
-                        True,
-                        product["active"],
-                        product["productNumber"],
-                    ),
-                )
-                count_update += 1
-            else:
-                cursor.execute(
-                    """
-                    UPDATE products
-                    SET name = ?, description = ?, active = ?, productNumber = ?
-                    WHERE shopware_id = ?
-                """,
-                    (
-                        product["name"],
-                        product["description"],
-                        product["active"],
-                        product["productNumber"],
-                        product["id"],
-                    ),
-                )
-                count_update += 1
+        for products in pages:
+            rows = product_rows(products)
+            new, updated = upsert_products_db(rows, conn)
 
-            counter += 1
-            conn.commit()
+            counter_new += new
+            count_update += updated
+            counter += len(rows)
 
-        if product_count < limit:
-            break
+            conn.commit()  # One transaction per page
 
-        page += 1
+    logging.info(
+        f"{count_update} Produkte geändert, {counter_new} neu, {counter} Produkte insgesamt"
+    )
 
-    logging.info(f"{count_update} Produkte aktualisiert, {counter} Produkte insgesamt")
-    close_db(conn)
 
+# Flattens a page of Shopware products and their variants into product rows
+# (shopware_id, name, description, active, productNumber, content_hash)
+def product_rows(products):
+    rows = []
 
-def valid_shopware_product():
-    base_url = os.getenv("SHOPWARE_URL")
+    for product in products:
+        if product["name"] is None:
+            logging.warning(f"Produkt hat keinen Namen, produktNumber: {product['productNumber']}")
+            continue
 
-    conn, cursor = get_db()
+        for child in product["children"] or []:
+            if child["name"] is None:
+                logging.warning(f"Produkt hat keinen Namen, produktNumber: {child['productNumber']}")
+                child["name"] = child["productNumber"]
 
-    def request(id):
-        try:
-            # Token bei jedem Request neu einlesen
-            with open("auth.json", "r") as f:
-                auth_data = json.load(f)
-
-            access_token = auth_data["shopware_token"]
-
-            auth_headers = {
-                "Accept": "application/json",
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            }
-
-            response = requests.get(
-                f"{base_url}/api/product/{id}",
-                headers=auth_headers,
-                timeout=10,  # 10 Sekunden Timeout
-            )
+            rows.append(product_row(child))
 
-            if response.status_code == 404:
-                return response.status_code
+        rows.append(product_row(product))
 
-            if response.status_code != 200:
-                logging.error(
-                    f"Fehler beim Abrufen des Shopware Produktes: {response.status_code}"
-                )
-                logging.error(f"Fehlerdetails: {response.text}")
-                return None
+    return rows
 
-            product_data = response.json()
-            return product_data["data"]
 
-        except requests.exceptions.Timeout:
-            logging.error("Timeout beim Abrufen des Shopware Produktes")
-            return None
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Fehler beim Abrufen des Shopware Produktes: {e}")
-            logging.error(f"Fehlerdetails: {str(e)}")
-            return None
-        except Exception as e:
-            logging.error(f"Error: {e}")
-            return None
+# Product row of a single Shopware product or variant, hashed over the stored fields
+def product_row(product):
+    values = (
+        product["name"],
+        product["description"],
+        product["active"],
+        product["productNumber"],
+    )
+    return (product["id"],) + values + (content_hash(*values),)
 
-    cursor.execute("""
-                   Select shopware_id from products WHERE is_in_shopware = 1
-                   """)
 
-    shopware_ids = cursor.fetchall()
+# Writes product rows with one batched upsert. Unchanged rows are skipped by their content
+# hash, changed rows already in Inventree get needs_update. Returns (new, changed) counts.
+def upsert_products_db(rows, conn=None):
+    with unit_of_work(conn) as (conn, cursor):
+        shopware_ids = list({row[0] for row in rows})  # Variants can also be listed on their own
 
-    for shopware_id in shopware_ids:
-        product = request(shopware_id[0])
+        cursor.execute(
+            "SELECT COUNT(*) FROM products WHERE shopware_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(shopware_ids),),
+        )
+        existing = cursor.fetchone()[0]
 
-        if product == 404:
-            cursor.execute(
-                """
-                UPDATE products
-                SET is_in_shopware = ?
-                WHERE shopware_id = ?
+        cursor.executemany(
+            """
+            INSERT INTO products (shopware_id, name, description, is_in_shopware, active, productNumber, content_hash)
+            VALUES (?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT (shopware_id) DO UPDATE SET
+                name = excluded.name,
+                description = excluded.description,
+                is_in_shopware = 1,
+                active = excluded.active,
+                productNumber = excluded.productNumber,
+                needs_update = CASE
+                    WHEN products.inventree_id IS NOT NULL AND products.content_hash IS NOT NULL THEN 1
+                    ELSE products.needs_update
+                END,
+                content_hash = excluded.content_hash
+            WHERE products.content_hash IS NOT excluded.content_hash
+            OR products.is_in_shopware IS NOT 1
             """,
-                (False, shopware_id[0]),
-            )
-            conn.commit()
-            logging.info(f"Produkt {shopware_id[0]} nicht mehr in Shopware")
+            rows,
+        )
+
+        new = len(shopware_ids) - existing
+        return new, max(cursor.rowcount - new, 0)
+
 
-    close_db(conn)
+# Marks products that were deleted in Shopware by diffing the Shopware product ids
+# against the products table
+def valid_shopware_product():
+    ids = shopware_ids("product")
+
+    if ids is None:
+        return
+
+    missing = diff_shopware_ids("products", ids)
+
+    if missing:
+        logging.info(f"{missing} Produkte nicht mehr in Shopware")
     logging.info("Shopware Produkte validiert")
 
 
+# Creates the missing parts in Inventree and PATCHes the parts whose Shopware data changed
 def sync_inventree():
+    link_existing_parts()
+    create_parts_inventree()
+    update_parts_inventree()
+
+    logging.info("Inventree Produkte synchronisiert")
 
-    base_url = os.getenv("INVENTREE_URL")
 
-    def request(data):
-        try:
-            # Token bei jedem Request neu einlesen
-            with open("auth.json", "r") as f:
-                auth_data = json.load(f)
-
-            access_token = auth_data["inventree_token"]
-
-            headers = {
-                "Accept": "application/json",
-                "Authorization": f"Token {access_token}",
-                "Content-Type": "application/json",
-            }
-
-            response = requests.post(
-                f"{base_url}/api/part/",
-                json=data,
-                timeout=10,
-                headers=headers,
-            )
+# Links products without a part to parts that already exist in Inventree, e.g. after the
+# database was lost. Parts are matched by IPN = productNumber first, then by a unique name.
+# Linked parts that differ from the product get needs_update, the others are left alone.
+def link_existing_parts():
+    with unit_of_work() as (conn, cursor):
+        cursor.execute("""
+            SELECT id, name, description, active, productNumber FROM products
+            WHERE is_in_shopware = 1 AND (is_in_inventree = 0 OR inventree_id IS NULL)
+            AND NOT EXISTS (SELECT 1 FROM overwrites o WHERE o.item = products.id)
+        """)
+        products = cursor.fetchall()
 
-            if response.status_code != 201:
-                logging.error(f"fehler beim erstellen dieses Produktes: {data}")
-                logging.error(f"Error response body: {response.text}")
-                return
+        if not products:
+            return
 
-            return response.json()
+        parts = inventree_list("/api/part/")
 
-        except requests.exceptions.Timeout:
-            logging.error("Request timed out after 10 seconds")
-            return None
+        if parts is None:
+            return
 
-        except requests.exceptions.RequestException as e:
-            logging.error(f"POST failed: {e}")
-            logging.error(f"Error details: {str(e)}")
-            return None
-        except Exception as e:
-            logging.error(f"Error: {e}")
-            return None
+        cursor.execute("SELECT inventree_id FROM products WHERE inventree_id IS NOT NULL")
+        linked = {str(row[0]) for row in cursor.fetchall()}
 
-    conn, cursor = get_db()
+        # Ambiguous keys map to None, they are not used for matching
+        by_ipn = {}
+        by_name = {}
+        for part in parts:
+            if part.get("IPN"):
+                by_ipn[part["IPN"]] = None if part["IPN"] in by_ipn else part
+            by_name[part["name"]] = None if part["name"] in by_name else part
 
-    cursor.execute("""
-        SELECT name, description, active, id FROM products WHERE is_in_shopware = 1 AND (is_in_inventree = 0 OR inventree_id IS NULL)
-    """)
-    products = cursor.fetchall()
+        rows = []
 
-    for product in products:
-        
-        cursor.execute("""SELECT id FROM overwrites WHERE item = ?""", (product[3],))
-        overwrite = cursor.fetchone()
-        
-        if overwrite is not None:
-            cursor.execute("""UPDATE products 
-                              SET is_in_inventree = 1
-                              WHERE id = ?""", (product[3],))
-            conn.commit()
-            continue
-        
-        # Sanitize description by removing problematic characters
-        if product[1]:
-            product_desc = (
-                product[1]
-                .replace("<", "")
-                .replace(">", "")
-                .replace("/", "")
-                .replace("\\", "")
-                .replace("div", "")
-                .replace('span="de"', "")
-            )
-        else:
-            product_desc = ""
+        def link(product, part):
+            payload = part_payload(product)
+            changed = any(part.get(field) != payload[field] for field in ("name", "description", "active"))
 
-        product_desc = product_desc[:250]
+            linked.add(str(part["pk"]))
+            rows.append((part["pk"], changed, product[0]))
 
-        name = product[0][:100]
-        
-        try:
-            active = product[2]
-            
-            if active != 1 or active != 0:
-                active = 1
-                
+        # All IPN matches first, so a name match can not take a part another product owns by IPN
+        unmatched = []
+        for product in products:
+            part = by_ipn.get(product[4])
+
+            if part is not None and str(part["pk"]) not in linked:
+                link(product, part)
             else:
-                active = bool(active)
-                
-        except Exception as e:
-            logging.error(f"Error: {e}")
-            active = 1
+                unmatched.append(product)
 
-        data = {
-            "name": name,
-            "description": product_desc,
-            "active": bool(active),
-            "minimum_stock": 10,  # Default Value
-            "salable": True,
-        }
+        for product in unmatched:
+            part = by_name.get(product[1][:100])
 
-        response = request(data)
+            if part is not None and str(part["pk"]) not in linked:
+                link(product, part)
 
-        cursor.execute(
-            """
-            UPDATE products
-            SET is_in_inventree = ?, inventree_id = ?
-            WHERE id = ?
-        """,
-            (True, response["pk"], product[3]),
+        cursor.executemany(
+            "UPDATE products SET inventree_id = ?, is_in_inventree = 1, needs_update = ? WHERE id = ?",
+            rows,
         )
 
+        logging.info(f"{len(rows)} Produkte mit vorhandenen Inventree Teilen verknüpft")
+
+
+def create_parts_inventree():
+    counter = 0
+
+    with unit_of_work() as (conn, cursor):
+        # Products that are replaced by an overwrite never get an own part
+        cursor.execute("""
+            UPDATE products SET is_in_inventree = 1
+            WHERE is_in_shopware = 1 AND (is_in_inventree = 0 OR is_in_inventree IS NULL)
+            AND EXISTS (SELECT 1 FROM overwrites o WHERE o.item = products.id)
+        """)
         conn.commit()
 
-    close_db(conn)
-    logging.info("Inventree Produkte synchronisiert")
+        # NOT EXISTS, a NOT IN over overwrites would match nothing once an item is NULL
+        cursor.execute("""
+            SELECT id, name, description, active, content_hash FROM products
+            WHERE is_in_shopware = 1 AND (is_in_inventree = 0 OR inventree_id IS NULL)
+            AND NOT EXISTS (SELECT 1 FROM overwrites o WHERE o.item = products.id)
+        """)
+        products = cursor.fetchall()
+
+        def flush(rows):
+            cursor.executemany(
+                """
+                UPDATE products SET is_in_inventree = 1, inventree_id = ?, needs_update = 0
+                WHERE id = ?
+                """,
+                rows,
+            )
+            conn.commit()
+
+        batch = Batch(flush)
+
+        for product, response in run_parallel(
+            lambda product: inventree_request("post", "/api/part/", data=new_part_payload(product)),
+            products,
+        ):
+            if response is not None:
+                batch.add((response["pk"], product[0]))
+                counter += 1
+
+        batch.flush_all()
+
+    logging.info(f"{counter} Produkte in Inventree erstellt")
+
+
+# Sends changed products (needs_update) to their existing part
+def update_parts_inventree():
+    counter = 0
+
+    with unit_of_work() as (conn, cursor):
+        cursor.execute("""
+            SELECT id, name, description, active, content_hash, inventree_id FROM products
+            WHERE needs_update = 1 AND inventree_id IS NOT NULL
+        """)
+        products = cursor.fetchall()
+
+        # The flag stays set if the product changed again while the PATCH was running
+        def flush(rows):
+            cursor.executemany(
+                "UPDATE products SET needs_update = 0 WHERE id = ? AND content_hash IS ?",
+                rows,
+            )
+            conn.commit()
+
+        batch = Batch(flush)
+
+        for product, response in run_parallel(
+            lambda product: inventree_request(
+                "patch", f"/api/part/{product[5]}/", data=part_payload(product)
+            ),
+            products,
+        ):
+            if response is not None:
+                batch.add((product[0], product[4]))
+                counter += 1
+
+        batch.flush_all()
+
+    if products:
+        logging.info(f"{counter} von {len(products)} geänderten Produkten in Inventree aktualisiert")
+
+
+# Part fields taken from Shopware for a product row (id, name, description, active, ...),
+# these are the only fields sent when a changed product is updated
+def part_payload(product):
+    # Sanitize description by removing problematic characters
+    if product[2]:
+        product_desc = (
+            product[2]
+            .replace("<", "")
+            .replace(">", "")
+            .replace("/", "")
+            .replace("\\", "")
+            .replace("div", "")
+            .replace('span="de"', "")
+        )
+    else:
+        product_desc = ""
+
+    return {
+        "name": product[1][:100],
+        "description": product_desc[:250],
+        "active": True if product[3] is None else bool(product[3]),  # Variants inherit active
+    }
+
+
+# Fields of a new part, the defaults are only set on creation so changes made in Inventree stay
+def new_part_payload(product):
+    return dict(
+        part_payload(product),
+        minimum_stock=10,  # Default Value
+        salable=True,
+    )
@@ -1,39 +1,162 @@
 import requests
 import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Any
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from log_config import setup_logging
-import json
+from auth import tokens, refresh_token
+from json_stream import JsonArrayStream
+from workers import Paginator, INVENTREE_WORKERS, INVENTREE_LINE_WORKERS
 
 logging = setup_logging()
 
-
-def shopware_request(
-    method: str,
-    endpoint: str,
-    data: Optional[tuple[Any, ...]] = None,
-    page: Optional[int] = None,
-    limit: Optional[int] = None,
-    additions: Optional[str] = None,
-    timeout: Optional[int] = 10,
-):
-    base_url = os.getenv("SHOPWARE_URL")
-
-    try:
-        with open("auth.json", "r") as f:
-            auth_data = json.load(f)
-
-        access_token = auth_data["shopware_token"]
-
-        auth_headers = {
-            "Accept": "application/json",
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-        }
-
-    except Exception as e:
-        logging.error(f"Failed to load auth data: {e}")
-        return None
-
+SHOPWARE_PAGE_SIZE = int(os.getenv("SHOPWARE_PAGE_SIZE", 500))  # Records per page of Shopware list requests
+SHOPWARE_ID_PAGE_SIZE = int(os.getenv("SHOPWARE_ID_PAGE_SIZE", 5000))  # Ids per page of /api/search-ids requests
+SHOPWARE_STREAM = os.getenv("SHOPWARE_STREAM", "false").lower() in ("1", "true", "yes")  # Decode large lists record by record
+STREAM_CHUNK_SIZE = 64 * 1024
+SHOPWARE_INCREMENTAL = os.getenv("SHOPWARE_INCREMENTAL", "true").lower() in ("1", "true", "yes")
+SHOPWARE_CHANGE_OVERLAP = int(os.getenv("SHOPWARE_CHANGE_OVERLAP", 60))  # Minutes re-read before the last change
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 20))  # Connections kept alive per backend
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))  # Retries for connection errors and 502/503/504
+SHOPWARE_RATE_LIMIT = float(os.getenv("SHOPWARE_RATE_LIMIT", 0))  # Requests per second, 0 = unlimited
+INVENTREE_RATE_LIMIT = float(os.getenv("INVENTREE_RATE_LIMIT", 20))
+INVENTREE_PAGE_SIZE = int(os.getenv("INVENTREE_PAGE_SIZE", 500))  # Records per page of Inventree list requests
+
+
+# Spaces requests evenly so no more than `rate` requests per second are sent, 0 disables the limit
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Holds a pooled keep-alive session for one backend, shared by all requests against it.
+# Requests to read_only_paths (path prefixes of POST endpoints that only read, like searches)
+# go through a second adapter that retries POST as well.
+class ApiClient:
+    def __init__(
+        self,
+        backend,
+        url_env,
+        auth_scheme,
+        rate_limit=0,
+        pool_size=HTTP_POOL_SIZE,
+        retries=HTTP_RETRIES,
+        read_only_paths=(),
+    ):
+        self.backend = backend
+        self.url_env = url_env
+        self.auth_scheme = auth_scheme
+        self.limiter = RateLimiter(rate_limit)
+        self.read_only_paths = read_only_paths
+        self._mounted_url = None
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]),
+            raise_on_status=False,
+        )  # POST is not idempotent and is never retried automatically
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        self.read_only_adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry.new(allowed_methods=retry.allowed_methods | {"POST"}),
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @property
+    def base_url(self):
+        return os.getenv(self.url_env)
+
+    # Mounts the retrying adapter for the read only paths, the base url is only known at runtime
+    def _mount_read_only(self, base_url):
+        if base_url == self._mounted_url:
+            return
+
+        for path in self.read_only_paths:
+            self.session.mount(f"{base_url}{path}", self.read_only_adapter)
+
+        self._mounted_url = base_url
+
+    def request(self, method, endpoint, **kwargs):
+        base_url = self.base_url
+
+        if self.read_only_paths:
+            self._mount_read_only(base_url)
+
+        self.limiter.wait()
+        return self.session.request(
+            method.upper(), f"{base_url}{endpoint}", **kwargs
+        )
+
+    # Sends an authenticated request, on 401 the token is refreshed once and the request repeated
+    def send(self, method, endpoint, **kwargs):
+        for attempt in range(2):
+            access_token = tokens.get(f"{self.backend}_token")
+
+            headers = {
+                "Accept": "application/json",
+                "Authorization": f"{self.auth_scheme} {access_token}",
+                "Content-Type": "application/json",
+            }
+
+            response = self.request(method, endpoint, headers=headers, **kwargs)
+
+            if response.status_code != 401 or attempt == 1:
+                return response
+
+            logging.warning(f"{self.backend.capitalize()} token rejected, refreshing")
+
+            if not refresh_token(self.backend, access_token):
+                return response
+
+            response.close()
+
+
+shopware_client = ApiClient(
+    "shopware",
+    "SHOPWARE_URL",
+    "Bearer",
+    SHOPWARE_RATE_LIMIT,
+    read_only_paths=("/api/search/", "/api/search-ids/"),  # Searches only read, retrying is safe
+)
+inventree_client = ApiClient(
+    "inventree",
+    "INVENTREE_URL",
+    "Token",
+    INVENTREE_RATE_LIMIT,
+    # Order lines run on a pool inside each order worker, every request needs a kept-alive connection
+    pool_size=max(HTTP_POOL_SIZE, INVENTREE_WORKERS * INVENTREE_LINE_WORKERS),
+)
+
+
+# Builds the query string for the paging parameters and additional arguments
+def build_query(page=None, limit=None, additions=None):
     url_param = ""
 
     if page is not None and limit is not None:
@@ -45,29 +168,32 @@ def shopware_request(
         else:
             url_param = f"?{additions}"
 
-    url = f"{base_url}{endpoint}{url_param}"
+    return url_param
 
-    try:
-        if method == "get":
-            if data is not None:
-                response = requests.get(
-                    url, headers=auth_headers, json=data, timeout=timeout
-                )
-            else:
-                response = requests.get(url, headers=auth_headers, timeout=timeout)
-
-        elif method == "post":
-            if data is not None:
-                response = requests.post(
-                    url, headers=auth_headers, json=data, timeout=timeout
-                )
-            else:
-                response = requests.post(url, headers=auth_headers, timeout=timeout)
 
-        else:
+def shopware_request(
+    method: str,
+    endpoint: str,
+    data: Optional[tuple[Any, ...]] = None,
+    page: Optional[int] = None,
+    limit: Optional[int] = None,
+    additions: Optional[str] = None,
+    timeout: Optional[int] = 10,
+):
+    url_param = build_query(page, limit, additions)
+
+    try:
+        if method not in ("get", "post"):
             logging.error(f"Invalid method: {method}")
             return None
 
+        response = shopware_client.send(
+            method,
+            f"{endpoint}{url_param}",
+            json=data,
+            timeout=timeout,
+        )
+
     except requests.exceptions.Timeout:
         logging.error("request timed out")
         return
@@ -83,10 +209,6 @@ def shopware_request(
         logging.error(f"Request failed with status code {response.status_code}")
         logging.error(f"Details: {response.text}")
         return None
-    
-    if response.status_code == 502:
-        logging.warning("Received 502 error, retrying request")
-        return shopware_request(method, endpoint, data, page, limit, additions, timeout)
 
     response_data = response.json()
 
@@ -106,67 +228,20 @@ def inventree_request(
     additions: Optional[str] = None,
     timeout: Optional[int] = 10,
 ):
-    base_url = os.getenv("INVENTREE_URL")
-
-    try:
-        # Token bei jedem Request neu einlesen
-        with open("auth.json", "r") as f:
-            auth_data = json.load(f)
-
-        access_token = auth_data["inventree_token"]
-
-        auth_headers = {
-            "Accept": "application/json",
-            "Authorization": f"Token {access_token}",
-            "Content-Type": "application/json",
-        }
-
-    except Exception as e:
-        logging.error(f"Failed to load auth data: {e}")
-        return None
-
-    url_param = ""
-
-    if page is not None and limit is not None:
-        url_param = f"?page={page}&limit={limit}"
-
-    if additions is not None:
-        if url_param != "":
-            url_param = f"{url_param}&{additions}"
-        else:
-            url_param = f"?{additions}"
-
-    url = f"{base_url}{endpoint}{url_param}"
+    url_param = build_query(page, limit, additions)
 
     try:
-        if method == "get":
-            if data is not None:
-                response = requests.get(
-                    url, headers=auth_headers, json=data, timeout=timeout
-                )
-            else:
-                response = requests.get(url, headers=auth_headers, timeout=timeout)
-
-        elif method == "post":
-            if data is not None:
-                response = requests.post(
-                    url, headers=auth_headers, json=data, timeout=timeout
-                )
-            else:
-                response = requests.post(url, headers=auth_headers, timeout=timeout)
-
-        elif method == "delete":
-            if data is not None:
-                response = requests.delete(
-                    url, headers=auth_headers, json=data, timeout=timeout
-                )
-            else:
-                response = requests.delete(url, headers=auth_headers, timeout=timeout)
-
-        else:
+        if method not in ("get", "post", "patch", "delete"):
             logging.error(f"Invalid method: {method}")
             return None
 
+        response = inventree_client.send(
+            method,
+            f"{endpoint}{url_param}",
+            json=data,
+            timeout=timeout,
+        )
+
     except requests.exceptions.Timeout:
         logging.error("request timed out")
         return
@@ -184,9 +259,172 @@ def inventree_request(
         if data is not None:
             logging.error(f"Data: {data}")
         return None
-    
-    if response.status_code == 502:
-        logging.warning("Received 502 error, retrying request")
-        return inventree_request(method, endpoint, data, page, limit, additions, timeout)
-    
+
     return response.json()
+
+
+# Every record of a paginated Inventree list endpoint. The pages after the first are fetched
+# concurrently. Returns None if a page failed, so callers never work on a partial index.
+def inventree_list(endpoint: str, additions: Optional[str] = None, limit: int = INVENTREE_PAGE_SIZE):
+    def fetch(page):
+        query = f"limit={limit}&offset={(page - 1) * limit}"
+        if additions is not None:
+            query = f"{query}&{additions}"
+
+        response = inventree_request("get", endpoint, additions=query, timeout=30)
+
+        if response is None:
+            return None
+
+        return response["results"], response["count"]
+
+    pages = Paginator(fetch, limit, INVENTREE_WORKERS)
+    records = [record for page in pages for record in page]
+
+    if not pages.complete:
+        logging.error(f"Inventree Liste {endpoint} konnte nicht vollständig geladen werden")
+        return None
+
+    return records
+
+
+# Builds a Shopware search criteria. includes maps entity aliases to the fields returned
+# for them, e.g. {"customer": ["id", "email"]}, so responses only carry the needed columns.
+# Associations have to be listed as a field of their parent and under their own alias.
+def build_criteria(
+    page=None,
+    limit=None,
+    ids=None,
+    filters=None,
+    sort=None,
+    associations=None,
+    includes=None,
+    total_count=False,
+):
+    criteria = {}
+
+    if page is not None:
+        criteria["page"] = page
+    if limit is not None:
+        criteria["limit"] = limit
+    if ids is not None:
+        criteria["ids"] = list(ids)
+    if filters:
+        criteria["filter"] = filters
+    if sort:
+        criteria["sort"] = [
+            {"field": field.lstrip("-"), "order": "DESC" if field.startswith("-") else "ASC"}
+            for field in sort
+        ]  # "-field" sorts descending, like the sort query parameter
+    if associations:
+        criteria["associations"] = {name: {} for name in associations}
+    if includes:
+        criteria["includes"] = includes
+    if total_count:
+        criteria["total-count-mode"] = 1
+
+    return criteria
+
+
+# Runs a criteria search against /api/search/<entity>, returns (data, total) like shopware_request
+def shopware_search(entity: str, criteria: dict, timeout: Optional[int] = 10):
+    return shopware_request("post", f"/api/search/{entity}", data=criteria, timeout=timeout)
+
+
+# Every id of a Shopware entity, fetched page by page from /api/search-ids. The pages are
+# sorted by id, so concurrent offset pages neither overlap nor skip rows. Returns None if a
+# page failed, an incomplete id set must not be used to detect deletions.
+def shopware_ids(entity: str, limit: int = SHOPWARE_ID_PAGE_SIZE):
+    pages = Paginator(
+        lambda page: shopware_request(
+            "post",
+            f"/api/search-ids/{entity}",
+            data=build_criteria(page=page, limit=limit, sort=["id"], total_count=True),
+            timeout=30,
+        ),
+        limit,
+    )
+    ids = [shopware_id for page in pages for shopware_id in page]
+
+    if not pages.complete:
+        logging.error(f"Shopware {entity} ids konnten nicht vollständig geladen werden")
+        return None
+
+    return ids
+
+
+# Like shopware_request, but the body is decoded while it is read. Returns a JsonArrayStream
+# yielding the records of "data" one by one (other keys end up in .meta), or None on errors.
+def shopware_stream(
+    method: str,
+    endpoint: str,
+    data: Optional[dict] = None,
+    page: Optional[int] = None,
+    limit: Optional[int] = None,
+    additions: Optional[str] = None,
+    timeout: Optional[int] = 30,
+):
+    url_param = build_query(page, limit, additions)
+
+    try:
+        response = shopware_client.send(
+            method,
+            f"{endpoint}{url_param}",
+            json=data,
+            timeout=timeout,
+            stream=True,
+        )
+
+    except requests.exceptions.Timeout:
+        logging.error("request timed out")
+        return None
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Request error: {e}")
+        return None
+
+    if response.status_code != 200:
+        logging.error(f"Request failed with status code {response.status_code}")
+        logging.error(f"Details: {response.text}")
+        response.close()
+        return None
+
+    return JsonArrayStream(
+        response.iter_content(STREAM_CHUNK_SIZE), on_close=response.close
+    )
+
+
+# Streaming variant of shopware_search, see shopware_stream
+def shopware_search_stream(entity: str, criteria: dict, timeout: Optional[int] = 30):
+    return shopware_stream("post", f"/api/search/{entity}", data=criteria, timeout=timeout)
+
+
+# Criteria filter matching entities created or changed at or after `since` minus `overlap`
+# minutes. The overlap catches rows whose timestamp was written shortly before they became
+# visible, and rows sharing the timestamp of the last change.
+def changed_since_filter(since, fields=("updatedAt", "createdAt"), overlap=SHOPWARE_CHANGE_OVERLAP):
+    since = datetime.fromisoformat(since.replace("Z", "+00:00")) - timedelta(minutes=overlap)
+    since = since.astimezone(timezone.utc).isoformat(timespec="milliseconds")
+
+    return [
+        {
+            "type": "multi",
+            "operator": "or",
+            "queries": [
+                {"type": "range", "field": field, "parameters": {"gte": since}}
+                for field in fields
+            ],
+        }
+    ]
+
+
+# Returns the newest updatedAt/createdAt of the given entities, or `latest` if none is newer.
+# Shopware timestamps share one format, so they compare correctly as strings.
+def latest_change(entities, latest=None, fields=("updatedAt", "createdAt")):
+    for entity in entities:
+        for field in fields:
+            value = entity.get(field)
+
+            if value is not None and (latest is None or value > latest):
+                latest = value
+
+    return latest
@@ -0,0 +1,181 @@
+import math
+import os
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from log_config import setup_logging
+
+logging = setup_logging()
+
+INVENTREE_WORKERS = int(os.getenv("INVENTREE_WORKERS", 8))  # Parallel requests against Inventree
+INVENTREE_LINE_WORKERS = int(os.getenv("INVENTREE_LINE_WORKERS", 4))  # Parallel line requests per order
+SHOPWARE_WORKERS = int(os.getenv("SHOPWARE_WORKERS", 4))  # Pages fetched ahead from Shopware
+SYNC_CHUNK_SIZE = int(os.getenv("SYNC_CHUNK_SIZE", 100))  # Rows written per transaction
+
+
+# Runs func for every item on a bounded thread pool and yields (item, result) as they finish.
+# A failing item is logged and yields None, so one bad row does not stop the others.
+def run_parallel(func, items, workers=INVENTREE_WORKERS):
+    def call(item):
+        try:
+            return func(item)
+        except Exception as e:
+            logging.error(f"Error processing {item}: {e}")
+            return None
+
+    if workers <= 1:
+        for item in items:
+            yield item, call(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(call, item): item for item in items}
+
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# Collects rows and hands them to flush in chunks, call flush_all() for the remainder
+class Batch:
+    def __init__(self, flush, size=SYNC_CHUNK_SIZE):
+        self.flush = flush
+        self.size = size
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+
+        if len(self.rows) >= self.size:
+            self.flush_all()
+
+    def flush_all(self):
+        if self.rows:
+            self.flush(self.rows)
+            self.rows = []
+
+
+# Iterates the pages of a paginated list in order. fetch(page) returns (data, total) or None,
+# total has to be the full result count (Shopware: total-count-mode 1). The first page tells
+# the page count, the following ones are fetched ahead on a bounded pool while the caller
+# processes the earlier ones. Iteration stops at the first failed page and complete is False.
+# complete is also False when less than total records arrived, e.g. if the server caps limit.
+class Paginator:
+    def __init__(self, fetch, limit, workers=SHOPWARE_WORKERS):
+        self.fetch = fetch
+        self.limit = limit
+        self.workers = workers
+        self.complete = True
+
+    def _fetch(self, page):
+        try:
+            return self.fetch(page)
+        except Exception as e:
+            logging.error(f"Error fetching page {page}: {e}")
+            return None
+
+    def __iter__(self):
+        first = self._fetch(1)
+
+        if first is None:
+            self.complete = False
+            return
+
+        data, total = first
+        received = len(data)
+        yield data
+
+        pages = math.ceil(total / self.limit)
+
+        if pages <= 1:
+            self._check(received, total)
+            return
+
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            pending = deque()
+            next_page = 2
+
+            while next_page <= pages and len(pending) < max(self.workers, 1):
+                pending.append(executor.submit(self._fetch, next_page))
+                next_page += 1
+
+            while pending:
+                response = pending.popleft().result()
+
+                if next_page <= pages:
+                    pending.append(executor.submit(self._fetch, next_page))
+                    next_page += 1
+
+                if response is None:
+                    self.complete = False
+
+                    for future in pending:
+                        future.cancel()
+                    return
+
+                received += len(response[0])
+                yield response[0]
+
+        self._check(received, total)
+
+    def _check(self, received, total):
+        if received < total and self.complete:
+            logging.error(f"Only {received} of {total} records received, the server may cap the page size")
+            self.complete = False
+
+
+# Iterates a paginated list page by page through streamed responses, see request.shopware_stream.
+# open_page(page) returns an iterable of records or None. Records are handed out in lists of at
+# most batch_size, so memory use does not grow with the page size. Pages are read one after
+# another until a page has less than limit records; on errors iteration stops and complete is False.
+class StreamPaginator:
+    def __init__(self, open_page, limit, batch_size=SYNC_CHUNK_SIZE):
+        self.open_page = open_page
+        self.limit = limit
+        self.batch_size = batch_size
+        self.complete = True
+
+    def __iter__(self):
+        page = 1
+
+        received = 0
+
+        while True:
+            stream = self.open_page(page)
+
+            if stream is None:
+                self.complete = False
+                return
+
+            count = 0
+            records = iter(stream)
+
+            try:
+                while True:
+                    batch = list(islice(records, self.batch_size))
+
+                    if not batch:
+                        break
+
+                    count += len(batch)
+                    yield batch
+
+            except Exception as e:
+                logging.error(f"Error reading page {page}: {e}")
+                self.complete = False
+                return
+
+            received += count
+            total = getattr(stream, "meta", {}).get("total")
+
+            if total is not None and received >= total:
+                return
+
+            if count < self.limit:
+                # A short page ends the list, unless total says records are missing
+                if total is not None and received < total:
+                    logging.error(f"Only {received} of {total} records received, the server may cap the page size")
+                    self.complete = False
+                return
+
+            page += 1